@@ -27,7 +27,7 @@ Created on Thu Jun 18 18:26:00 2020
 ------------
 
 conda config --add channels conda-forge
-conda create --name hh_py39 python=3.9 gdal matplotlib seaborn pandas geopandas scikit-image pysal rasterio xarray rioxarray rasterstats spyder
+conda create --name hh_py39 python=3.9 gdal matplotlib seaborn pandas geopandas scikit-image scipy pysal rasterio spyder
 
 """
 
@@ -59,12 +59,26 @@ tasks = [
 country_processing = 'Peru_HH'
 # country_processing = 'Ecuador_HH'
 
+# Number of processes running tasks at the same time (1 runs sequentially)
+workers = 1
+
+# True to only print the plan (what would be built or reused, estimated
+# time and memory) without running any task
+plan_only = False
+
+# True to save cProfile stats of every task in the results folder, besides
+# the run report (run_report.json/.csv) that is always saved
+profile = False
+
 # Don't change the following
 # Process Human Footprint maps according to settings
-for purpose in purposes:
-    begin_HF(purpose, tasks, country_processing)
-
-end_time = time.monotonic()
-print('\007')
-print(f'Total time: {timedelta(seconds=end_time - start_time)}')
-print("------ FIN ------")
+# (guarded, as workers of the pool import this module)
+if __name__ == '__main__':
+    for purpose in purposes:
+        begin_HF(purpose, tasks, country_processing, workers, plan_only,
+                 profile)
+
+    end_time = time.monotonic()
+    print('\007')
+    print(f'Total time: {timedelta(seconds=end_time - start_time)}')
+    print("------ FIN ------")
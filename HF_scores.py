@@ -52,6 +52,21 @@ Trail_score = 1.25
 # Other settings
 Indirect_max_hours = 4
 
+# River speeds (km/h) from Rodrigo Sierra's speeds research in Ecuador.
+# Rows are elevation ranges (m) and columns slope ranges, by upper limit.
+# First ranges include 0. Outside the table, elevation gets 5000 and slope 1000
+River_elevation_limits = (450, 700, 1800, 2800, 10000)
+River_slope_limits = (5, 10, 15, 25, 1000)
+River_speeds = (
+    (15, 7.5, 3.8, 1.9, 1.4),
+    (7.5, 3.9, 2.7, 1.9, 1.4),
+    (3.8, 2.7, 2.0, 1.7, 1.4),
+    (1.9, 1.9, 1.7, 1.4, 1.3),
+    (1.4, 1.4, 1.4, 1.3, 1.2),
+)
+River_speed_out_elevation = 5000
+River_speed_out_slope = 1000
+
 
 # GHF for scoring template adapted from the Global Human Footprint maps
 GHF = {
@@ -89,6 +104,7 @@ GHF = {
         'direct_score': 0,
         'max_score_exp': Land_use_change_score,
         'min_score_exp': 0,
+        'max_score': Land_use_change_score, #  Scores are capped
         'max_dist': Indirect_max_hours*36000, #  Times raster in 10s
     },
 
@@ -46,7 +46,6 @@ general_settings = {
         'slope_path': 'Oficial/IGM/Elevacion/slope_grass.tif',
         'coast_path': 'Oficial/Límite_CONALI/Costa_CONALI_2019.shp',
         'flooded_path': 'Oficial/MAAE/Ecosistema_inundados_fill.tif',
-        'split_folder': 'HF_maps/01_Limits/split_folder//',
         'scoring_template': 'GHF',
         'purpose_layers': {
 
@@ -340,8 +339,6 @@ general_settings = {
         # 'slope_path': 'No_Oficial/dem_PECO_mainland_bbox/dem_Pe_slope_grass.tif',
         'coast_path': 'Oficial/IGN/Costa_IGN.shp',
         'flooded_path': 'Oficial/MINAM/Geoservidor/Cobertura_Vegetal/mapa_cobertura_vegetal_2015/Ecosistemas_inundados.tif',
-        # 'split_folder': 'HF_maps/01_Limits/polygons_split_rivers//',
-        'split_folder': 'HF_maps/01_Limits/polygons_split//',
         'purpose_layers': {
 
 
@@ -651,7 +648,6 @@ class GENERAL_SETTINGS:
         self.slope_path = settings_c['slope_path']
         self.coast_path = settings_c['coast_path']
         self.flooded_path = settings_c['flooded_path']
-        self.split_folder = settings_c['split_folder']
         # self.river_mask = settings_c['river_mask']
 
 
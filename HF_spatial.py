@@ -27,30 +27,74 @@ Created on Thu Jun 18 18:26:00 2020
 """
 
 import os
-import copy
 import math
+import json
+import time
+import hashlib
+import cProfile
+import functools
+from contextlib import contextmanager
+from glob import glob
 # import sys
 import numpy as np
 # from math import sqrt
 from osgeo import gdal, ogr, osr
 import HF_scores
 from HF_layers import layers_settings
-from HF_layers import multitemporal_layers
 import rasterio
-import rioxarray as rxr
-from skimage import graph
-import xarray as xr
+from scipy import ndimage
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 import geopandas as gpd
-from rasterio.merge import merge
-from rasterio.mask import mask
+import shapely
 from rasterio.enums import Resampling
+from rasterio.windows import Window
+from rasterio.warp import reproject, transform_bounds
 from datetime import datetime
-import random
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 ogr.UseExceptions()
 today_date = datetime.today().strftime('%Y-%m-%d')
 
+# Compression of all rasters written: codec ('DEFLATE', 'ZSTD' or 'LZW'),
+# predictor (True to use one) and level (1-9 for DEFLATE, 1-22 for ZSTD,
+# not used by LZW)
+raster_compression = {'codec': 'DEFLATE', 'predictor': True, 'level': 6}
+
+# Data type and NoData value of each class of raster created by the
+# pipeline, the narrowest type that holds its values:
+#   mask: presence (1) or absence (0), e.g. rasterized roads, crops, built.
+#   proximity: meters up to MAXDIST, 65535 beyond it (as gdal.ComputeProximity).
+#   times: 10 seconds to cross a pixel, clipped to 65534.
+#   scores: scored, combined and added pressures.
+raster_dtypes = {
+    'mask': ('Byte', None),
+    'proximity': ('UInt16', None),
+    'times': ('UInt16', 65535),
+    'scores': ('Float32', -9999),
+    }
+
+# Value of proximity rasters beyond their maximum distance
+proximity_far = 65535
+
+# Point and line layers of up to this number of features get their proximity
+# from their geometries instead of from a rasterized layer
+vector_proximity_features = 10000
+
+# Version of the code that creates prepared, scored and combined rasters.
+# Change it when a change in the code changes their values, so the cached
+# ones are created again
+CODE_VERSION = '2041005'
+
 class RASTER():
     """
     Class for working with rasters.
@@ -90,6 +134,22 @@ class RASTER():
         self.array = self.bd.ReadAsArray()
         return self.array
 
+    def get_window(self, window):
+        """
+        Reads only a window of the band, so large rasters can be processed
+        block by block.
+
+        Parameters
+        ----------
+        window : (xoff, yoff, xsize, ysize) as yielded by block_windows.
+
+        Returns
+        -------
+        Array of the window.
+
+        """
+        return self.bd.ReadAsArray(*window)
+
     def close(self):
         """
         Closes the class instance. Needed to save changes.
@@ -178,40 +238,74 @@ class VECTOR():
         self.geom_type = None
 
 
-def compress(pressure_path):
+def creation_options(DataType='Float32', as_list=True):
     """
-    Compresses a raster.
+    Creation options of GeoTIFFs, so rasters are written tiled and
+    compressed in one pass, according to raster_compression.
+    More info at https://gdal.org/drivers/raster/gtiff.html
+
+    Parameters
+    ----------
+    DataType : GDAL or numpy data type name, to choose the predictor
+    (3 for floats, 2 for integers). The default is 'Float32'.
+    as_list : True for GDAL (['COMPRESS=DEFLATE', ...]), False for
+    rasterio ({'compress': 'DEFLATE', ...}). The default is True.
+
+    Returns
+    -------
+    options : list or dict of creation options.
+
+    """
+
+    codec = raster_compression['codec'].upper()
+    options = {'tiled': 'YES', 'blockxsize': 256, 'blockysize': 256,
+               'bigtiff': 'YES', 'compress': codec,
+               'num_threads': 'ALL_CPUS'}
+
+    if raster_compression['predictor']:
+        options['predictor'] = 3 if 'float' in str(DataType).lower() else 2
+
+    if raster_compression['level']:
+        if codec == 'DEFLATE':
+            options['zlevel'] = raster_compression['level']
+        elif codec == 'ZSTD':
+            options['zstd_level'] = raster_compression['level']
+
+    if as_list:
+        return [f'{key.upper()}={value}' for key, value in options.items()]
+    return options
+
+
+def cog_options(DataType='Float32', overviews=4):
+    """
+    Creation options of Cloud Optimized GeoTIFFs (COG driver), with the
+    compression of creation_options and internal overviews.
     More info at https://gdal.org/drivers/raster/cog.html
+
     Parameters
     ----------
-    pressure_uncomp_path : uncompressed path of existing raster.
-    pressure_path : compressed output raster.
+    DataType : GDAL or numpy data type name, to choose the predictor.
+    The default is 'Float32'.
+    overviews : number of overviews (2, 4, 8, ...). The default is 4.
 
     Returns
     -------
-    None.
+    options : list of creation options for gdal.Translate.
 
     """
 
-    # Get new name for temporal uncompressed raster
-    path0 = pressure_path.split('/')
-    path1 = path0[-1].split(".")
-    path1[0] = path1[0] + '_uncomp'
-    path1 = '.'.join(path1)
-    path0[-1] = path1
-    pressure_uncomp_path = '/'.join(path0)
+    gtiff = creation_options(DataType, as_list=False)
+    options = {'compress': gtiff['compress'], 'blocksize': 256,
+               'bigtiff': 'IF_SAFER', 'num_threads': 'ALL_CPUS',
+               'resampling': 'NEAREST', 'overview_count': overviews}
+
+    if 'predictor' in gtiff:
+        options['predictor'] = 'YES'
 
-    # Copy raster to new name and delete original
-    # command = f'gdalmanage copy  "{pressure_path}" "{pressure_uncomp_path}"'
-    # os.system(command)
-    shutil.copy2(pressure_path, pressure_uncomp_path)
-    os.remove(pressure_path)
+    if raster_compression['level'] and 'LZW' not in gtiff['compress']:
+        options['level'] = raster_compression['level']
 
-    # Compress and remove uncompressed
-    creation_options = ["COMPRESS=LZW", "TILED=YES", "BIGTIFF=YES"]#, "stats=True"]  # , "PREDICTOR=3"]
-    reduced_raster = gdal.Translate(pressure_path, pressure_uncomp_path, creationOptions=creation_options)
-    reduced_raster = None
-    os.remove(pressure_uncomp_path)
+    return [f'{key.upper()}={value}' for key, value in options.items()]
 
 
 def create_base_raster(base_path, settings, res):
@@ -235,74 +329,51 @@ def create_base_raster(base_path, settings, res):
 
     extent_polygon = VECTOR(settings.extent_Polygon)
     extent = extent_polygon.extent  # tuple(w,e,s,n)
+    layer_name = extent_polygon.layer.GetName()
+    extent_polygon.close()
 
-    # Create command string
-    command = [
-        'gdal_rasterize',
-        '-l', extent_polygon.name,
+    # Options as in gdal_rasterize
+    options = [
+        '-l', layer_name,
         '-burn', 1.0,
         '-tr', res, res,
         '-a_nodata', -9999.0,
         '-te', extent[0], extent[2], extent[1], extent[3],
         '-ot', 'Float32',
         '-of', 'GTiff',
-        '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=2', '-co', 'ZLEVEL=9',
-        f'"{settings.extent_Polygon}"',
-        f'"{base_path}"',]
-
-    command = ' '.join(str(i) for i in command)
-
-    # Execute command line
-    os.system(command)
-
-
-def clip_raster_by_extent(out_path, raster_to_clip, settings, base_path):
-    # Open the raster datasets
-    ds_to_clip = gdal.Open(raster_to_clip, gdal.GA_Update)
-    ds_base = gdal.Open(base_path)
-
-    # Read the raster bands
-    band_to_clip = ds_to_clip.GetRasterBand(1)
-    band_base = ds_base.GetRasterBand(1)
+        ]
+    for option in creation_options('Float32'):
+        options += ['-co', option]
 
-    # Get the NoData value of the base raster
-    base_nodata = band_base.GetNoDataValue()
-    to_clip_nodata = band_to_clip.GetNoDataValue()
+    # Rasterize in this process, raising errors
+    base_ds = gdal.Rasterize(base_path, settings.extent_Polygon,
+                             options=[str(i) for i in options])
+    check_gdal_result(base_ds, 'Rasterizing base raster', base_path)
+    base_ds = None
 
-    # Read the data as numpy arrays
-    data_to_clip = band_to_clip.ReadAsArray()
-    data_base = band_base.ReadAsArray()
-
-    # Set NoData pixels in the raster_to_clip using base_nodata value
-    data_to_clip[data_base == base_nodata] = to_clip_nodata
-
-    # Write the updated data back to the raster_to_clip
-    band_to_clip.WriteArray(data_to_clip)
-
-    # Close the raster datasets
-    ds_to_clip = None
-    ds_base = None
 
+def check_gdal_result(result, task, out_path):
+    """
+    Raises an error if a GDAL utility (gdal.Rasterize, gdal.VectorTranslate)
+    failed, removing its incomplete output so it isn't reused later.
 
+    Parameters
+    ----------
+    result : dataset returned by the utility, None if it failed.
+    task : description of the task for the error message.
+    out_path : path of the output.
 
-def GetGeoInfo(base_raster):
-    """
-    Returns base raster settings
-    NDV, xsize, ysize, GeoT, Projection, DataType
+    Returns
+    -------
+    None.
 
-    https://gis.stackexchange.com/questions/57005/python-gdal-write-new-raster-using-projection-from-old
     """
 
-    NDV = base_raster.bd.GetNoDataValue()
-    if NDV == None: NDV = -9999
-    xsize = base_raster.ds.RasterXSize
-    ysize = base_raster.ds.RasterYSize
-    GeoT = base_raster.ds.GetGeoTransform()
-    Projection = osr.SpatialReference()
-    Projection.ImportFromWkt(base_raster.ds.GetProjectionRef())
-    DataType = base_raster.dataType_name
+    if result is None:
+        if os.path.isfile(out_path):
+            os.remove(out_path)
+        raise RuntimeError(f'{task} failed: {gdal.GetLastErrorMsg()}')
 
-    return NDV, xsize, ysize, GeoT, Projection, DataType
 
 def ParseType(type):
     """
@@ -335,92 +406,701 @@ def ParseType(type):
         return gdal.GDT_Byte
 
 
-def CreateGeoTiff(path, Array, driver, NDV,
-                  xsize, ysize, GeoT, Projection, DataType):
+def create_empty_raster(path, base_raster, DataType='Float32', kind=None):
     """
-    Creates a new raster from
-    path, Array, driver, NDV, xsize, ysize, GeoT, Projection, DataType
+    Creates a new raster with the dimensions, geotransform, projection and
+    NoData value of base raster, without reading or writing the base array.
+    Values are written afterwards, e.g. window by window.
+
+    Parameters
+    ----------
+    path : path of the new raster.
+    base_raster : RASTER or BASE_GRID instance of the base raster.
+    DataType : GDAL data type name. The default is 'Float32'.
+    kind : class of raster in raster_dtypes (e.g. 'mask'). If given, its
+    data type and NoData value are used instead. The default is None.
+
+    Returns
+    -------
+    DataSet : GDAL dataset open for writing. Set to None to close it.
 
-    Function to write a new file
-    https://gis.stackexchange.com/questions/57005/python-gdal-write-new-raster-using-projection-from-old
     """
-    DataType = ParseType(DataType)
-    DataSet = driver.Create(path, xsize, ysize, 1, DataType)
-    # the '1' is for band 1.
-    DataSet.SetGeoTransform(GeoT)
-    DataSet.SetProjection(Projection.ExportToWkt())
-    # Write the array
-    DataSet.GetRasterBand(1).WriteArray(Array)
-    DataSet.GetRasterBand(1).SetNoDataValue(NDV)
-    DataSet = None
+
+    NDV = base_raster.nodata
+    if kind:
+        DataType, NDV = raster_dtypes[kind]
+    driver = gdal.GetDriverByName('GTiff')
+    DataSet = driver.Create(path, base_raster.XSize, base_raster.YSize, 1,
+                            ParseType(DataType), creation_options(DataType))
+    DataSet.SetGeoTransform(base_raster.geotrans)
+    DataSet.SetProjection(base_raster.projref)
+    if NDV is not None:
+        DataSet.GetRasterBand(1).SetNoDataValue(NDV)
+
+    return DataSet
 
 
-def copy_raster(path, base_raster, Float=True, array=False):
+def block_windows(raster, min_rows=256):
     """
-    Copies a raster to another path according to base raster.
-    If array is provided, it will create a copy of base raster with new values.
+    Yields windows of full rows to process a raster block by block.
+    The height of the windows is a multiple of the block height of the
+    raster (256 for the layout of creation_options), so each
+    block is read only once and memory depends on window size instead of
+    raster size.
+
+    Parameters
+    ----------
+    raster : RASTER instance.
+    min_rows : minimum number of rows per window. The default is 256.
+
+    Yields
+    ------
+    window : (xoff, yoff, xsize, ysize).
 
-    https://gis.stackexchange.com/questions/57005/python-gdal-write-new-raster-using-projection-from-old
     """
 
-    # Open the original file
-    if type(array) == bool:
-        base_raster.get_array()
-        array = base_raster.array
+    block_rows = raster.bd.GetBlockSize()[1]
+    rows = block_rows * max(1, int(np.ceil(min_rows / block_rows)))
 
-    # Get the raster info
-    NDV, xsize, ysize, GeoT, Projection, DataType = GetGeoInfo(base_raster)
+    for yoff in range(0, raster.YSize, rows):
+        yield (0, yoff, raster.XSize, min(rows, raster.YSize - yoff))
 
-    # Set up the GTiff driver
-    driver = gdal.GetDriverByName('GTiff')
 
-    # Change DataType to Float if necessary
-    if Float:
-        DataType = 'Float32'
-    else:
-        DataType = 'Int32'
+def create_base_mask(base_path):
+    """
+    Saves the mask of the study area (pixels of base raster that are not
+    NoData) once per base raster, bit-packed by rows in a .npy file next to
+    it ({base}_mask.npy), so writers can clip to the study area without
+    reading the base raster again.
+
+    Parameters
+    ----------
+    base_path : path to base raster.
 
-    # Now turn the array into a GTiff.
-    CreateGeoTiff(path, array, driver, NDV,
-                  xsize, ysize, GeoT, Projection, DataType)
+    Returns
+    -------
+    mask_path : path to the bit-packed mask.
 
+    """
 
-def createRasterFromCopy(fn, ds, data):
-    """ Similar method as previous, merge """ #  TODO
-    driver = gdal.GetDriverByName('GTiff')
-    outds = driver.CreateCopy(fn, ds, strict=0)
-    band_out = outds.GetRasterBand(1)
-    band_out.WriteArray(data)
-    band_out.ComputeStatistics(0)
-    ds = None
-    outds = None
-    band_out = None
+    return create_packed_mask(base_path,
+                              base_path.replace('.tif', '_mask.npy'))
+
+
+def create_packed_mask(raster_path, mask_path, value=None):
+    """
+    Saves a mask of a raster bit-packed by rows in a .npy file, unless it's
+    newer than the raster, so it can be memory-mapped (also by the workers
+    of a pool) and read by windows with get_mask_window.
+
+    Parameters
+    ----------
+    raster_path : path to raster.
+    mask_path : path to the bit-packed mask.
+    value : pixels equal to value are True. If None, pixels that are not
+    NoData are True. The default is None.
+
+    Returns
+    -------
+    mask_path : path to the bit-packed mask.
+
+    """
+
+    if (os.path.isfile(mask_path)
+            and os.path.getmtime(mask_path) >= os.path.getmtime(raster_path)):
+        return mask_path
+
+    raster = RASTER(raster_path)
+    mask = np.lib.format.open_memmap(
+        mask_path, mode='w+', dtype=np.uint8,
+        shape=(raster.YSize, (raster.XSize + 7) // 8))
+    for window in block_windows(raster):
+        array = raster.get_window(window)
+        if value is None:
+            array_mask = array != raster.nodata
+        else:
+            array_mask = array == value
+        mask[window[1]:window[1] + window[3]] = np.packbits(array_mask,
+                                                            axis=1)
+    mask.flush()
+    mask = None
+    raster.close()
+
+    return mask_path
+
+
+def get_mask_window(mask, window):
+    """
+    Unpacks a window of the mask of the study area.
+
+    Parameters
+    ----------
+    mask : bit-packed mask, e.g. BASE_GRID.mask.
+    window : (xoff, yoff, xsize, ysize) as yielded by block_windows.
+
+    Returns
+    -------
+    Boolean array of the window, True inside the study area.
+
+    """
+
+    xoff, yoff, xsize, ysize = window
+    bits = mask[yoff:yoff + ysize, xoff // 8:(xoff + xsize + 7) // 8]
+    bits = np.unpackbits(bits, axis=1)
+    return bits[:, xoff % 8:xoff % 8 + xsize].astype(bool)
+
+
+class BASE_GRID():
+    """
+    Grid of the base raster: size, geotransform, projection and mask of the
+    study area. It is saved once per base raster (extent and resolution)
+    next to it, as {base}_grid.json and the bit-packed {base}_mask.npy, and
+    read from there memory-mapped, so stages and worker processes don't
+    open and decompress the base raster again. The mask is created when
+    it's first used.
+    Use get_base_grid to keep one instance per process.
+
+    Parameters
+    ----------
+    base_path : path to base raster.
+    persist : False to read the grid without saving anything next to the
+    base raster (e.g. to plan tasks). The default is True.
+    """
+
+    def __init__(self, base_path, persist=True):
+        self.path = base_path
+        self._mask = None
+        grid_path = base_path.replace('.tif', '_grid.json')
+
+        # Read the grid from the base raster if the saved one is older,
+        # and save it
+        if os.path.isfile(grid_path) and \
+                os.path.getmtime(grid_path) >= os.path.getmtime(base_path):
+            with open(grid_path) as f:
+                grid = json.load(f)
+        else:
+            base_raster = RASTER(base_path)
+            grid = {'XSize': base_raster.XSize,
+                    'YSize': base_raster.YSize,
+                    'geotrans': base_raster.geotrans,
+                    'projref': base_raster.projref,
+                    'crs_authority': base_raster.crs_authority,
+                    'nodata': base_raster.nodata,
+                    'block_rows': base_raster.bd.GetBlockSize()[1]}
+            base_raster.close()
+            if persist:
+                with open(grid_path, 'w') as f:
+                    json.dump(grid, f)
+
+        self.XSize = grid['XSize']
+        self.YSize = grid['YSize']
+        self.geotrans = tuple(grid['geotrans'])
+        self.resX = self.geotrans[1]
+        self.resY = - self.geotrans[5]
+        self.projref = grid['projref']
+        self.crs_authority = grid['crs_authority']
+        self.nodata = grid['nodata']
+        self.block_rows = grid['block_rows']
+
+    @property
+    def mask(self):
+        """ Bit-packed mask of the study area, memory-mapped """
+        if self._mask is None:
+            self._mask = np.load(create_base_mask(self.path), mmap_mode='r')
+        return self._mask
+
+    def bounds(self):
+        """ Bounds of the grid as (xmin, ymin, xmax, ymax) """
+        xmin, ymax = self.geotrans[0], self.geotrans[3]
+        xmax = xmin + self.geotrans[1] * self.XSize
+        ymin = ymax + self.geotrans[5] * self.YSize
+        return xmin, ymin, xmax, ymax
+
+    def fingerprint(self):
+        """ Size, geotransform and projection of the grid """
+        return [self.XSize, self.YSize, self.geotrans, self.projref]
+
+    def windows(self, min_rows=256):
+        """ Windows of full rows of the grid, as block_windows """
+        rows = self.block_rows * max(1, int(np.ceil(min_rows / self.block_rows)))
+        for yoff in range(0, self.YSize, rows):
+            yield (0, yoff, self.XSize, min(rows, self.YSize - yoff))
+
+    def get_mask_window(self, window):
+        """ Window of the mask of the study area, True inside """
+        return get_mask_window(self.mask, window)
+
+
+_base_grids = {}
+
+
+def get_base_grid(base_path, persist=True):
+    """
+    Returns the BASE_GRID of a base raster, loaded once per process.
+
+    Parameters
+    ----------
+    base_path : path to base raster.
+    persist : False to not save the grid next to the base raster if it's
+    loaded now. The default is True.
+
+    Returns
+    -------
+    BASE_GRID instance.
+
+    """
+
+    if base_path not in _base_grids:
+        _base_grids[base_path] = BASE_GRID(base_path, persist)
+    return _base_grids[base_path]
+
+
+def file_fingerprint(path):
+    """
+    Fingerprint of a source file: name, size and modification time of the
+    file and of its sidecar files (e.g. .dbf and .prj of a shapefile).
+
+    """
+
+    stem, ext = os.path.splitext(path)
+    paths = sorted(set(glob(f'{stem}.*')) | {path})
+
+    return [[os.path.basename(p), os.path.getsize(p), os.stat(p).st_mtime_ns]
+            for p in paths if os.path.isfile(p)]
+
+
+def grid_fingerprint(base_path):
+    """ Size, geotransform and projection of the base raster """
+    return get_base_grid(base_path).fingerprint()
+
+
+def artifact_input(path):
+    """
+    Describes an input for the key of an artifact: the key of the input if
+    it's an artifact itself, otherwise its file fingerprint.
+
+    """
+
+    metadata_path = f'{path}.json'
+    if os.path.isfile(metadata_path):
+        with open(metadata_path) as f:
+            return json.load(f)['key']
+    return file_fingerprint(path)
+
+
+def artifact_key(inputs):
+    """ Hash of all inputs of an artifact and of the code version """
+    inputs = dict(inputs, code_version=CODE_VERSION)
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def is_cached(path, key):
+    """
+    Checks if an artifact exists and was created from the same inputs.
+    Artifacts without metadata are considered stale.
+
+    """
+
+    metadata_path = f'{path}.json'
+    if not os.path.isfile(path) or not os.path.isfile(metadata_path):
+        return False
+    with open(metadata_path) as f:
+        return json.load(f).get('key') == key
+
+
+def save_artifact_metadata(path, key, inputs):
+    """ Saves key and inputs of an artifact next to it ({path}.json) """
+    with open(f'{path}.json', 'w') as f:
+        json.dump({'key': key, 'inputs': inputs,
+                   'code_version': CODE_VERSION,
+                   'created': datetime.now().isoformat(timespec='seconds')},
+                  f, indent=1, sort_keys=True, default=str)
+
+
+def remove_artifacts(paths):
+    """ Removes stale artifacts, their metadata and intermediate files """
+    for path in paths:
+        for p in (path, f'{path}.json', f'{path}.aux.xml'):
+            if os.path.isfile(p):
+                os.remove(p)
+
+
+def prepared_artifact(layer, year, settings, base_path, purpose,
+                      scoring_template, scoring_method, main_folder, res,
+                      multitemp):
+    """
+    Path of a prepared pressure and the key of its inputs. Parameters as in
+    PREPARING.
+
+    Returns
+    -------
+    pressure_path, key, inputs
+
+    """
+
+    extent = settings.extent_Polygon
+    extent = extent.split('/')[-1].split('.')[-2]
+    year_txt = f'{year}_' if multitemp else ''
+    purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
+    pressure_path = f'{main_folder}/HF_maps/b03_Prepared_pressures/{extent}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_prepared.tif'
+
+    inputs = prepared_inputs(layer, year, settings, base_path, purpose,
+                             scoring_template, scoring_method,
+                             main_folder, res, multitemp)
+
+    return pressure_path, artifact_key(inputs), inputs
+
+
+def prepared_inputs(layer, year, settings, base_path, purpose,
+                    scoring_template, scoring_method, main_folder, res,
+                    multitemp):
+    """
+    Inputs a prepared pressure is made from: layer settings and source
+    files, scores of the scoring method, extent and base raster grid.
+    Indirect pressures also depend on the combined Land_Cover and
+    Built_Environments, the prepared roads and the river settings.
+
+    Returns
+    -------
+    inputs : dict for artifact_key.
+
+    """
+
+    extent_str = settings.extent_Polygon.split('/')[-1].split('.')[-2]
+    inputs = {
+        'layer': layers_settings[layer],
+        'sources': [file_fingerprint(f'{main_folder}{path}')
+                    for path in layers_settings[layer]['path']],
+        'scores': getattr(HF_scores, scoring_template).get(scoring_method),
+        'extent': extent_str,
+        'clip': settings.clip_by_Polygon,
+        'grid': grid_fingerprint(base_path),
+        }
+
+    if scoring_method in ('indirect_scores'):
+        added = f'{main_folder}HF_maps/b05_Added_pressures/p_{{}}_{extent_str}_{purpose}_{year}_{scoring_template}_{res}m.tif'
+        inputs['combined'] = [artifact_input(added.format(pressure))
+                              for pressure in ('Land_Cover', 'Built_Environments')]
+        inputs['roads'] = [
+            prepared_artifact(layer_roads, year, settings, base_path, purpose,
+                              scoring_template,
+                              layers_settings[layer_roads]['scoring'],
+                              main_folder, res, False)[1]
+            for layer_roads in settings.purpose_layers[purpose]['pressures']['Roads_Railways']['datasets']]
+        inputs['others'] = [file_fingerprint(main_folder + path) for path in
+                            (settings.flooded_path, settings.coast_path,
+                             settings.elev_path, settings.slope_path)]
+        inputs['rivers'] = {name: getattr(HF_scores, name)
+                            for name in dir(HF_scores)
+                            if name.startswith('River_')}
+
+    return inputs
+
+
+def prepared_intermediates(layer, year, settings, purpose, scoring_template,
+                           scoring_method, main_folder, res, multitemp):
+    """
+    Intermediate files written while preparing a pressure, which are reused
+    by name and have to be removed with a stale prepared pressure.
+    Intermediates of indirect pressures shared by all years and purposes
+    (rivers, flooded, coast, elevation and slope) are not included: they
+    don't change with the year and other processes may be reading them.
+
+    Returns
+    -------
+    paths : list of paths.
+
+    """
+
+    extent_str = settings.extent_Polygon.split('/')[-1].split('.')[-2]
+    folder = f'{main_folder}HF_maps/b03_Prepared_pressures/{extent_str}_{layer}'
+    year_txt = f'{year}_' if multitemp else ''
+    purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
+
+    paths = [f'{folder}_{scoring_template}_clip_proj.gpkg',
+             f'{folder}_{res}m_rasterized.tif']
+
+    if scoring_method in ('indirect_scores'):
+        paths += [f'{folder}_crops_{year_txt}{purp}{res}m.tif',
+                  f'{folder}_built_{year_txt}{purp}{res}m.tif',
+                  f'{folder}_times10s_{year_txt}{purp}{res}m.tif',
+                  f'{folder}_sources_{year_txt}{purp}{res}m.gpkg']
+
+    return paths
+
+
+def process_counters():
+    """
+    CPU time, peak resident memory and bytes read and written by this
+    process so far. Counters that can't be measured in this platform are
+    None. Memory and disk counters come from psutil if it's installed,
+    otherwise from /proc (Linux) or resource.
+
+    """
+
+    counters = {'cpu': time.process_time(), 'peak_rss': None,
+                'read': None, 'written': None}
+
+    if psutil:
+        process = psutil.Process()
+        counters['peak_rss'] = getattr(process.memory_info(), 'peak_wset', None)
+        try:
+            io = process.io_counters()
+            counters['read'], counters['written'] = io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+
+    if counters['peak_rss'] is None and os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    counters['peak_rss'] = int(line.split()[1]) * 1024
+    if counters['peak_rss'] is None and resource:
+        counters['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    if counters['read'] is None and os.path.isfile('/proc/self/io'):
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        counters['read'] = int(io['read_bytes'])
+        counters['written'] = int(io['write_bytes'])
+
+    return counters
+
+
+def reset_peak_rss():
+    """ Resets the peak resident memory of this process (only in Linux) """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+# Measures of the stages of this process, see instrument
+stage_records = []
+_open_stages = []
+
+
+@contextmanager
+def instrument(stage, pixels=None, profile_path=None, **labels):
+    """
+    Measures a stage of the workflow: wall time, CPU time, peak resident
+    memory, MB read and written, and pixels processed. The measures are
+    added to stage_records when the stage ends. Stages can be nested, e.g.
+    compute_cost_path within PREPARING.
+
+    Parameters
+    ----------
+    stage : name of the stage, e.g. 'SCORING'.
+    pixels : pixels processed. The default is None.
+    profile_path : path to save cProfile stats of the stage (.prof), None
+    to not profile it. The default is None.
+    **labels : other fields of the record, e.g. layer and year.
+
+    Yields
+    ------
+    record : dict of measures, completed when the stage ends.
+
+    """
+
+    # Keep the peak the enclosing stage reached before resetting it
+    record = dict(stage=stage, **labels)
+    if _open_stages:
+        _open_stages[-1]['nested_peak'] = max(
+            _open_stages[-1].get('nested_peak', 0),
+            process_counters()['peak_rss'] or 0)
+    _open_stages.append(record)
+    reset_peak_rss()
+    profiler = cProfile.Profile() if profile_path else None
+    start, before = time.monotonic(), process_counters()
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield record
+
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+            profiler.dump_stats(profile_path)
+        after = process_counters()
+        _open_stages.pop()
+
+        # Peak before and within nested stages too, as they reset the peak
+        # of the process
+        peak = max(after['peak_rss'] or 0, record.pop('nested_peak', 0))
+        if _open_stages:
+            _open_stages[-1]['nested_peak'] = max(
+                _open_stages[-1].get('nested_peak', 0), peak)
+
+        record['wall_s'] = time.monotonic() - start
+        record['cpu_s'] = after['cpu'] - before['cpu']
+        record['peak_rss_mb'] = peak / 2**20 if peak else None
+        for name in ('read', 'written'):
+            record[f'{name}_mb'] = None if after[name] is None else \
+                (after[name] - before[name]) / 2**20
+        record['pixels'] = pixels
+        stage_records.append(record)
+
+
+def instrumented(function):
+    """ Decorator to measure every call of a function with instrument """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with instrument(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def default_nodata(dtype):
+    """ NoData value for a data type when the source has none """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind == 'u':
+        return np.iinfo(dtype).max
+    return np.iinfo(dtype).min
+
+
+def warp_to_base(in_paths, out_paths, base_path, resampling, dtype=None,
+                 nodata=None, nodata_to_0=False):
+    """
+    Warps rasters to the grid of base raster window by window. For each
+    window of the base raster, only the part of the sources that covers it
+    (plus a margin for the resampling kernel) is read and reprojected, and
+    the result is written to tiled compressed rasters, so memory doesn't
+    depend on the size of the sources.
+    Sources on the same grid (e.g. versions of a multitemporal layer) are
+    warped together as bands of one reprojection, so the geometry of the
+    warp is computed once for all of them.
+
+    Parameters
+    ----------
+    in_paths : path or list of paths of rasters to warp.
+    out_paths : path or list of paths for warped rasters, one per in_path.
+    base_path : path to base raster.
+    resampling : rasterio.enums.Resampling method.
+    dtype : data type of warped rasters. The default is the source's.
+    nodata : NoData value of warped rasters. The default is the source's.
+    nodata_to_0 : True to change NoData of the sources to 0 before warping.
+    The default is False.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    if isinstance(in_paths, str):
+        in_paths, out_paths = [in_paths], [out_paths]
+
+    # Group sources by grid, NoData and data type, and outputs by source
+    groups = {}
+    for in_path, out_path in zip(in_paths, out_paths):
+        with rasterio.open(in_path) as src:
+            grid = (src.crs.to_wkt(), tuple(src.transform), src.width,
+                    src.height, str(src.nodata), src.dtypes[0])
+        groups.setdefault(grid, {}).setdefault(in_path, []).append(out_path)
+
+    windows = list(get_base_grid(base_path).windows())
+
+    for sources in groups.values():
+
+        srcs = [rasterio.open(in_path) for in_path in sources]
+        src = srcs[0]
+        band_dtype = dtype or src.dtypes[0]
+        src_nodata = src.nodata
+        band_nodata = nodata
+        if band_nodata is None:
+            band_nodata = src_nodata if src_nodata is not None else default_nodata(band_dtype)
+
+        with rasterio.open(base_path) as base:
+
+            profile = {'driver': 'GTiff', 'width': base.width,
+                       'height': base.height, 'count': 1, 'crs': base.crs,
+                       'transform': base.transform, 'dtype': band_dtype,
+                       'nodata': band_nodata,
+                       **creation_options(band_dtype, False)}
+            dsts = [[rasterio.open(out_path, 'w', **profile)
+                     for out_path in out_paths_src]
+                    for out_paths_src in sources.values()]
+
+            for window in windows:
+                dst_window = Window(*window)
+                destination = np.full((len(srcs), window[3], window[2]),
+                                      band_nodata, band_dtype)
+
+                # Window of sources covering the window of base raster
+                bounds = rasterio.windows.bounds(dst_window, base.transform)
+                src_bounds = transform_bounds(base.crs, src.crs, *bounds,
+                                              densify_pts=21)
+                src_window = rasterio.windows.from_bounds(
+                    *src_bounds, transform=src.transform)
+
+                # Margin of source pixels for the resampling kernel
+                pad = 2 + math.ceil(max(src_window.width / window[2],
+                                        src_window.height / window[3]))
+                col0 = max(0, math.floor(src_window.col_off) - pad)
+                row0 = max(0, math.floor(src_window.row_off) - pad)
+                col1 = min(src.width, math.ceil(src_window.col_off + src_window.width) + pad)
+                row1 = min(src.height, math.ceil(src_window.row_off + src_window.height) + pad)
+
+                # Reproject only if sources cover the window
+                if col0 < col1 and row0 < row1:
+                    src_window = Window(col0, row0, col1 - col0, row1 - row0)
+                    source = np.stack([s.read(1, window=src_window)
+                                       for s in srcs]).astype(band_dtype)
+                    if nodata_to_0 and src_nodata is not None:
+                        source[source == src_nodata] = 0
+
+                    reproject(source, destination,
+                              src_transform=src.window_transform(src_window),
+                              src_crs=src.crs, src_nodata=src_nodata,
+                              dst_transform=rasterio.windows.transform(
+                                  dst_window, base.transform),
+                              dst_crs=base.crs, dst_nodata=band_nodata,
+                              resampling=resampling)
+
+                for band, dsts_src in zip(destination, dsts):
+                    for dst in dsts_src:
+                        dst.write(band, 1, window=dst_window)
+
+            for dsts_src in dsts:
+                for dst in dsts_src:
+                    dst.close()
+
+        for s in srcs:
+            s.close()
 
 
 def warp_raster(layer, settings, base_path, pressure_path, scoring_template,
-                scoring_method, main_folder):#, raster_list=False
-    #  TODO don't use raster_list
+                scoring_method, main_folder, batch=None):
     """
-    Warps a raster to match base raster's settings.
-    Special cases are considered.
+    Warps a raster to match base raster's settings, window by window of the
+    base raster (see warp_to_base), with the resampling method of the
+    scoring method and NoData of the source as 0.
 
     Parameters
     ----------
     layer : Layer name of the pressure/dataset.
     settings : general settings from GENERAL_SETTINGS class.
-        base_path : path to base raster.
+    base_path : path to base raster.
     pressure_path : path for the output warped raster.
     scoring_template : Name of the scoring template from HF_scores.
         E.g. 'GHF'.
     scoring_method : scoring method is a setting of each layer and will
         determine the type of preparing and scoring. Comes from HF_layers.
     main_folder : Name of folder in root for all analysis.
-    raster_list : optional. The default is False.
-        If more than one raster is to be warped, it returns a list.
+    batch : optional list of (in_path, out_path) of other versions of a
+        multitemporal layer to warp in the same pass. The default is None.
 
     Returns
     -------
-    new_in_paths : List of warped rasters, if necessary.
+    None.
 
     """
 
@@ -467,19 +1147,12 @@ def warp_raster(layer, settings, base_path, pressure_path, scoring_template,
             if resampling_method == 'bilinear': rm = Resampling.bilinear
             if resampling_method == 'mode': rm = Resampling.mode
 
-            # 
-            base_raster = rxr.open_rasterio(base_path)
-            # nd = base_raster.rio.nodata
-            raster_to_warp = rxr.open_rasterio(in_path)
-            raster_to_warp = raster_to_warp.astype('float32')
-            nd_dataset = raster_to_warp.rio.nodata
-            raster_to_warp = raster_to_warp.where(raster_to_warp != nd_dataset, 0)
-            # raster_to_warp = raster_to_warp.where(raster_to_warp != -9999, -9998)
-            warped_raster = raster_to_warp.rio.reproject_match(base_raster, resampling=rm, nodata=-9999)
-            # if nd_dataset != np.float64('nan'): 
-            #     print('y')
-            #     warped_raster.rio.write_nodata(nd_dataset)
-            warped_raster.rio.to_raster(final_path)
+            # Warp window by window, NoData of the sources as 0
+            batch = batch or []
+            warp_to_base([in_path] + [b[0] for b in batch],
+                         [final_path] + [b[1] for b in batch],
+                         base_path, rm, dtype='float32', nodata=-9999,
+                         nodata_to_0=True)
 
 
             # # If nodata value in warp is nan, replace with 0
@@ -511,9 +1184,6 @@ def warp_raster(layer, settings, base_path, pressure_path, scoring_template,
             # new_in_paths.append(in_path)
             print(f'            {layer} already prepared')
 
-    # if raster_list:
-    #     return new_in_paths
-
 
 def small_warp_raster(layer, base_path, in_path, out_path, settings, nd=99,
                       ratio=1):
@@ -526,22 +1196,7 @@ def small_warp_raster(layer, base_path, in_path, out_path, settings, nd=99,
 
     rm = Resampling.bilinear
 
-    base_raster = rxr.open_rasterio(base_path)
-    raster_to_warp = rxr.open_rasterio(in_path)
-    warped_raster = raster_to_warp.rio.reproject_match(base_raster, resampling=rm)
-    warped_raster.rio.to_raster(out_path)
-
-    # Compress
-    compress(out_path)
-
-
-def save_array(bd, array):
-    """ Saves an array into a band and computes statistics. """
-    bd.WriteArray(array)
-    nodata = bd.GetNoDataValue()
-    if nodata == 0:
-        bd.SetNoDataValue(-9999)
-    bd.ComputeStatistics(0)
+    warp_to_base(in_path, out_path, base_path, rm)
 
 
 def scores_to_0(value):
@@ -549,11 +1204,237 @@ def scores_to_0(value):
     return 0
 
 
+def bins_kernel(method_scores, nodata=None, denom=None):
+    """
+    Compiles a 'bins' scoring function from HF_scores.
+    Bins must be ordered by their lower limit, as they are in HF_scores.
+    When a value is on the limit of two bins, the later bin is used.
+
+    Parameters
+    ----------
+    method_scores : settings of the scoring method in the scoring template.
+    nodata : NoData value of the prepared raster. Not used.
+    denom : units denominator. Not used.
+
+    Returns
+    -------
+    kernel : function scoring an array in one pass.
+
+    """
+
+    lows = np.array([i[0][0] for i in method_scores['scores_by_bins']], dtype=np.float64)
+    highs = np.array([i[0][1] for i in method_scores['scores_by_bins']], dtype=np.float64)
+    scores = np.array([i[1] for i in method_scores['scores_by_bins']], dtype=np.float64)
+    if np.any(np.diff(lows) < 0):
+        raise ValueError('Bins of scores must be ordered by their lower limit')
+
+    def kernel(array, direct_array=None):
+        # Compare in the precision of the array, as with scalar limits
+        dtype = array.dtype if array.dtype.kind == 'f' else np.float64
+        lows_, highs_ = lows.astype(dtype), highs.astype(dtype)
+
+        # Bin of each pixel, values outside of all bins remain the same
+        idx = np.searchsorted(lows_, array, side='right') - 1
+        np.clip(idx, 0, None, out=idx)
+        goods = (lows_[0] <= array) & (array <= highs_[idx]) & (array != 65535)
+        scored_array = np.where(goods, scores[idx], array).astype(np.float32)
+
+        # Value when proximity is empty
+        scored_array[array == 65535] = 0
+
+        return scored_array
+
+    return kernel
+
+
+def categories_kernel(method_scores, nodata=None, denom=None):
+    """
+    Compiles a 'categories' scoring function from HF_scores as a lookup
+    table indexed by the integer categories of the raster.
+    Categories as text are scored while rasterizing and can't be compiled.
+
+    Parameters
+    ----------
+    method_scores : settings of the scoring method in the scoring template.
+    nodata : NoData value of the prepared raster. Scored as 0.
+    denom : units denominator. Not used.
+
+    Returns
+    -------
+    kernel : function scoring an array in one pass.
+
+    """
+
+    categories = method_scores['scores_by_categories']
+    values = [val for cat in categories for val in categories[cat][1]]
+    if not all(isinstance(val, (int, np.integer)) for val in values):
+        raise ValueError('Only integer categories can be scored from rasters')
+
+    # Later categories overwrite previous ones, as in a loop over categories
+    lut = np.zeros(max(values) + 1, dtype=np.float64)
+    in_lut = np.zeros(max(values) + 1, dtype=bool)
+    for cat in categories:
+        for val in categories[cat][1]:
+            lut[val] = categories[cat][0]
+            in_lut[val] = True
+    max_val = len(lut) - 1
+
+    def kernel(array, direct_array=None):
+        inside = (0 <= array) & (array <= max_val) & (array == np.floor(array))
+        idx = np.where(inside, array, 0).astype(np.intp)
+        goods = inside & in_lut[idx]
+        scored_array = np.where(goods, lut[idx], array).astype(np.float32)
+        if nodata is not None:
+            scored_array[array == nodata] = 0
+        return scored_array
+
+    return kernel
+
+
+def exp_kernel(method_scores, nodata=None, denom=None):
+    """
+    Compiles an 'exp' scoring function from HF_scores.
+    Pixels at distance 0, or 1 in direct_array (e.g. built areas), get the
+    direct score. If 'max_score' is in the scoring method, scores are capped.
+
+    Parameters
+    ----------
+    method_scores : settings of the scoring method in the scoring template.
+    nodata : NoData value of the prepared raster. Not used.
+    denom : denominator to convert the units of the raster to the units
+    of the exponential decay.
+
+    Returns
+    -------
+    kernel : function scoring an array in one pass.
+
+    """
+
+    direct_score = method_scores['direct_score']
+    max_score_exp = method_scores['max_score_exp']
+    min_score_exp = method_scores['min_score_exp']
+    max_dist = method_scores['max_dist']
+    max_score = method_scores.get('max_score')
+
+    def kernel(array, direct_array=None):
+        direct = array == 0
+        if direct_array is not None:
+            direct = np.logical_or(direct, direct_array == 1)
+        decay = max_score_exp * np.exp(-(array / denom)) + min_score_exp
+        if max_score is not None:
+            decay = np.where(decay < max_score, decay, max_score)
+        return np.where(array > max_dist, 0,
+                        np.where(direct, direct_score, decay))
+
+    return kernel
+
+
+def log_kernel(method_scores, nodata=None, denom=None):
+    """
+    Compiles a 'log' scoring function from HF_scores.
+
+    Parameters
+    ----------
+    method_scores : settings of the scoring method in the scoring template.
+    nodata : NoData value of the prepared raster. Not used.
+    denom : units denominator. Not used.
+
+    Returns
+    -------
+    kernel : function scoring an array in one pass.
+
+    """
+
+    max_score = method_scores['max_score']
+    mult_factor = method_scores['mult_factor']
+    min_threshold = method_scores['min_threshold']
+    max_threshold = method_scores['max_threshold']
+    scaling_factor = method_scores['scaling_factor']
+
+    def kernel(array, direct_array=None):
+        inner = np.clip(array, min_threshold, max_threshold)
+        inner = mult_factor * np.log10(((inner - min_threshold) / scaling_factor) + 1)
+        scored_array = np.where(array < min_threshold, 0,
+                                np.where(array > max_threshold, max_score, inner))
+        scored_array = np.where(scored_array > max_score, max_score, scored_array)
+        return np.where(scored_array < 0, 0, scored_array)
+
+    return kernel
+
+
+def linear_kernel(method_scores, nodata=None, denom=None):
+    """
+    Compiles a 'linear' scoring function from HF_scores.
+
+    Parameters
+    ----------
+    method_scores : settings of the scoring method in the scoring template.
+    nodata : NoData value of the prepared raster. Not used.
+    denom : units denominator. Not used.
+
+    Returns
+    -------
+    kernel : function scoring an array in one pass.
+
+    """
+
+    max_score = method_scores['max_score']
+    max_threshold = method_scores['max_threshold']
+    min_threshold = method_scores['min_threshold']
+
+    def kernel(array, direct_array=None):
+        inner = np.interp(array, (min_threshold, max_threshold), (0, max_score))
+        scored_array = np.where(array < min_threshold, 0,
+                                np.where(array > max_threshold, max_score, inner))
+        return scored_array.astype(np.float32)
+
+    return kernel
+
+
+# Scoring kernels by type of function ('func') of the scoring templates
+scoring_kernels = {
+    'bins': bins_kernel,
+    'categories': categories_kernel,
+    'exp': exp_kernel,
+    'log': log_kernel,
+    'linear': linear_kernel,
+}
+
+
+def compile_scoring_kernel(scoring_template, scoring_method, nodata=None,
+                           denom=None):
+    """
+    Compiles the scoring function of a scoring method only once, so every
+    window of a raster is scored in a single pass.
+
+    Parameters
+    ----------
+    scoring_template : Name of the scoring template from HF_scores. E.g. 'GHF'.
+    scoring_method : scoring method from HF_layers.
+    nodata : NoData value of the prepared raster.
+    denom : denominator to convert units, for distance decays.
+
+    Returns
+    -------
+    kernel : function(array, direct_array=None) returning scores.
+
+    """
+
+    template = getattr(HF_scores, scoring_template)
+    method_scores = template[scoring_method]
+    return scoring_kernels[method_scores['func']](method_scores, nodata, denom)
+
+
 def reproject_shapefile(in_path, out_path, layer, settings):
     """
     Copies and or Reprojects a shapefile to match the coordinate system of the base layer.
-    As defined here:
+    Runs ogr2ogr in this process with gdal.VectorTranslate, as defined here:
         https://gdal.org/programs/ogr2ogr.html
+    When clipping by the extent polygon, only features within its bounding
+    box are read (using the spatial index of the source) before clipping.
+    Features are not read as Arrow batches (pyogrio.read_arrow): it needs
+    pyarrow, which isn't a dependency of the project, and reprojection and
+    clipping would run in Python instead of inside GDAL.
 
     Parameters
     ----------
@@ -576,10 +1457,11 @@ def reproject_shapefile(in_path, out_path, layer, settings):
     # Continue if does not exist
     if not out_exists:
 
-        # Get geometry type from input layer
-        pressure_vector = VECTOR(in_path)
-        geom_type = pressure_vector.geom_type_num
-        pressure_vector.close()
+        # Get geometry type from input layer, opened read only so several
+        # processes can read the same source
+        pressure_ds = ogr.Open(in_path)
+        geom_type = ogr.GT_Flatten(pressure_ds.GetLayer().GetGeomType())
+        pressure_ds = None
 
         if geom_type in (1, 4):
             geom_type = 'MULTIPOINT'
@@ -589,39 +1471,308 @@ def reproject_shapefile(in_path, out_path, layer, settings):
             geom_type = 'MULTIPOLYGON'
         # print('geom_type', geom_type)
 
-        # Create command string
-        c1 = ['ogr2ogr','-f', '"GPKG"',
-              '-t_srs', f'EPSG:{settings.crs_authority}',
-              '-nlt', f'"{geom_type}"',
-              ]
-        if settings.clip_by_Polygon:
-            c2 = ['-clipsrc',
-            f'"{settings.extent_Polygon}"',]
-        else:
-            c2 = []
-        c3 =[f'"{out_path}"', f'"{in_path}"',]
+        # Options as in ogr2ogr
+        options = ['-f', 'GPKG',
+                   '-t_srs', f'EPSG:{settings.crs_authority}',
+                   '-nlt', geom_type,
+                   ]
+        if settings.clip_by_Polygon:
+            extent_ds = ogr.Open(settings.extent_Polygon)
+            w, e, s, n = extent_ds.GetLayer().GetExtent()
+            extent_ds = None
+            options += ['-spat', w, s, e, n,
+                        '-spat_srs', f'EPSG:{settings.crs_authority}',
+                        '-clipsrc', settings.extent_Polygon]
+
+        # Translate in this process, raising errors
+        out_ds = gdal.VectorTranslate(out_path, in_path,
+                                      options=[str(i) for i in options])
+        check_gdal_result(out_ds, f'Reprojecting {layer}', out_path)
+        out_ds = None
+
+    else:
+        print(f'               {layer} was already reprojected')
+
+
+def category_scores(values, scores_by_categories):
+    """
+    Translates the distinct categories of a string field to scores.
+    Each category is looked up once, instead of once per feature.
+
+    Parameters
+    ----------
+    values : distinct categories (strings) found in the field.
+    scores_by_categories : dictionary of topic: (score, categories) from
+        the scoring method in HF_scores.
+
+    Returns
+    -------
+    Dictionary of category: score. Categories not found score 999.
+
+    """
+
+    value_scores = {}
+    for value_str in values:
+        value_int = None
+        for topic in scores_by_categories:
+            if value_str is not None and \
+                    value_str in scores_by_categories[topic][1]:
+                value_int = scores_by_categories[topic][0]
+
+        # Silly value to catch missing values
+        if value_int is None:
+            print(f'Problem string {value_str}')
+            value_int = 999
+        value_scores[value_str] = value_int
+
+    return value_scores
+
+
+def category_scores_sql(field, layer_name, value_scores):
+    """
+    Builds a query adding the field Use_int with the score of each category.
+    Scores are mapped by the SQLite engine of the GPKG, so gdal.Rasterize
+    burns them directly. Mapping an Arrow column instead (pyogrio) needs
+    pyarrow, which isn't a dependency of the project, and the mapped values
+    would have to be written to a layer again to be rasterized.
+
+    Parameters
+    ----------
+    field : name of the string field with categories.
+    layer_name : name of the layer in the vector dataset.
+    value_scores : dictionary of category: score from category_scores.
+
+    Returns
+    -------
+    SQL statement as string.
+
+    """
+
+    cases = ''
+    for value_str, value_int in value_scores.items():
+        if value_str is None:
+            continue
+        value_sql = value_str.replace("'", "''")
+        cases += f" WHEN '{value_sql}' THEN {float(value_int)}"
+    if not cases:
+        return f'SELECT *, 999.0 AS Use_int FROM "{layer_name}"'
+
+    return (f'SELECT *, CASE "{field}"{cases} ELSE 999.0 END AS Use_int '
+            f'FROM "{layer_name}"')
+
+
+def rasterize_shapefile(in_path, out_path, layer, settings, base_path):
+    """
+    Burns a shapefile into a raster (rasterize) on the grid of base raster.
+    If Field is specified in layer settings, it burns a categorical value
+    (Float32), otherwise it burns presence as 1 (Byte).
+
+    Parameters
+    ----------
+    in_path : path to shapefile to rasterize.
+    out_path : path to new raster.
+    layer : name of the layer
+    settings : general settings from GENERAL_SETTINGS class.
+    base_path : path to base raster.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    print('            Rasterizing ' + layer)
+
+    # Search for pressure layer if exists
+    out_exists = os.path.isfile(out_path)
+
+    # Continue if does not exist
+    if not out_exists:
+
+        # Vector layer as a raster (read only, the GPKG is not modified)
+        clipped_vector = ogr.Open(in_path)
+        clipped_layer = clipped_vector.GetLayer()
+        layer_name = clipped_layer.GetName()
+
+        # Get field for rasterizing
+        try:
+            field = layers_settings[layer]['cat_field']
+        except KeyError:
+            field = None
+
+        # Is field exists, check if it'a string field
+        field_is_string = False
+        if field:
+            layer_defn = clipped_layer.GetLayerDefn()
+            field_index = layer_defn.GetFieldIndex(field)
+            if field_index >= 0:
+                field_defn = layer_defn.GetFieldDefn(field_index)
+                field_type = field_defn.GetFieldTypeName(field_defn.GetType())
+                if field_type == 'String':
+                    field_is_string = True
+
+        # If field is string, translate categories to numbers in the query
+        burn_sql = None
+        if field_is_string:
+
+            # Import scoring methods to assign a number to land use categories
+            scoring_method = layers_settings[layer]['scoring']
+            scores_full = getattr(HF_scores, settings.scoring_template)
+            scores = scores_full[scoring_method]
+
+            # Distinct categories only, instead of every feature
+            distinct = clipped_vector.ExecuteSQL(
+                f'SELECT DISTINCT "{field}" FROM "{layer_name}"')
+            values = [feature.GetField(0) for feature in distinct]
+            clipped_vector.ReleaseResultSet(distinct)
+            value_scores = category_scores(
+                values, scores['scores_by_categories'])
+
+            # Map categories to scores through the native SQL of the GPKG
+            burn_sql = category_scores_sql(field, layer_name, value_scores)
+
+        # Grid of the base raster
+        base_grid = get_base_grid(base_path)
+        options = [
+            '-te', *base_grid.bounds(),
+            '-ts', base_grid.XSize, base_grid.YSize,
+            '-a_srs', base_grid.projref,
+            '-init', 0,
+            '-of', 'GTiff',
+            ]
+
+        # Values to burn decide the data type: categorical scores or
+        # presence/absence mask
+        if burn_sql:
+            options += ['-sql', burn_sql, '-a', 'Use_int']
+        elif field:
+            options += ['-l', layer_name, '-a', field]
+        else:
+            options += ['-l', layer_name,
+                        '-burn', 1,
+                        '-at',  # burn all pixels touched
+                        ]
+        DataType, NDV = raster_dtypes['scores' if field else 'mask']
+        options += ['-ot', DataType]
+        if NDV is not None:
+            options += ['-a_nodata', NDV]
+        for option in creation_options(DataType):
+            options += ['-co', option]
+
+        # Rasterize vector layer in one pass to a new zeroed raster
+        rasterized_ds = gdal.Rasterize(out_path, in_path,
+                                       options=[str(i) for i in options])
+        check_gdal_result(rasterized_ds, f'Rasterizing {layer}', out_path)
+        rasterized_ds.GetRasterBand(1).ComputeStatistics(0)
+
+        # Close everything
+        rasterized_ds = None
+        clipped_vector = None
+
+    else:
+        print(f'               {layer} was already rasterized')
+
+
+def proximity_maxdist(scoring_template, scoring_method, default=20000):
+    """
+    Distance up to which proximity changes the scores of a scoring method,
+    so proximity rasters are computed only up to it. Pixels further away
+    are proximity_far, which is scored as 0.
+        - bins: lower limit of the last bins, up to inf, that score 0.
+        E.g. 2 for (((0, 2), 8.75), ((2, inf), 0)), so only rasterized
+        pixels are scored (presence).
+        - other functions: 'max_dist' if it's in the scoring method.
+    Otherwise, or if the distance is over default, default is used.
+
+    Parameters
+    ----------
+    scoring_template : Name of the scoring template from HF_scores. E.g. 'GHF'.
+    scoring_method : scoring method of the layer in the template.
+    default : maximum distance in meters. The default is 20000.
+
+    Returns
+    -------
+    maxdist : maximum distance in meters.
+
+    """
+
+    method_scores = getattr(HF_scores, scoring_template).get(scoring_method, {})
+    maxdist = default
+
+    if method_scores.get('func') == 'bins':
+        bins = method_scores['scores_by_bins']
+        if bins[-1][0][1] == np.inf:
+            for (low, high), score in reversed(bins):
+                if score != 0:
+                    break
+                maxdist = low
+
+    elif 'max_dist' in method_scores:
+        maxdist = method_scores['max_dist']
+
+    return min(maxdist, default)
+
+
+def proximity_tile(in_path, window, halo, maxdist):
+    """
+    Distances from each pixel of a tile to the closest non-zero pixel of a
+    raster, in georeferenced units as gdal.ComputeProximity with
+    DISTUNITS=GEO, with an exact Euclidean distance transform.
+    The tile is read with a halo around it, so all targets up to maxdist
+    away are found. Used by proximity_raster, also in parallel processes.
+
+    Parameters
+    ----------
+    in_path : path to rasterized layer.
+    window : (xoff, yoff, xsize, ysize) of the tile.
+    halo : pixels added to each side of the tile.
+    maxdist : maximum distance. Pixels further away are proximity_far.
+
+    Returns
+    -------
+    window : same window.
+    proximity : array of distances of the tile, rounded, as uint16.
+
+    """
 
-        command = ' '.join(str(i) for i in c1+c2+c3)
+    xoff, yoff, xsize, ysize = window
+    with rasterio.open(in_path) as src:
+        col_off, row_off = max(0, xoff - halo), max(0, yoff - halo)
+        col_end = min(src.width, xoff + xsize + halo)
+        row_end = min(src.height, yoff + ysize + halo)
+        targets = src.read(1, window=Window(col_off, row_off, col_end - col_off,
+                                            row_end - row_off)) != 0
+        resX, resY = abs(src.transform.a), abs(src.transform.e)
 
-        # Execute command line
-        os.system(command)
+    # Without targets, all the tile is further than maxdist
+    if not targets.any():
+        return window, np.full((ysize, xsize), proximity_far, dtype=np.uint16)
 
-    else:
-        print(f'               {layer} was already reprojected')
+    distances = ndimage.distance_transform_edt(~targets, sampling=(resY, resX))
+    distances = distances[yoff - row_off:yoff - row_off + ysize,
+                          xoff - col_off:xoff - col_off + xsize]
+    proximity = np.where(distances <= maxdist, np.rint(distances), proximity_far)
 
+    return window, proximity.astype(np.uint16)
 
-def rasterize_shapefile(in_path, out_path, layer, settings, base_path):
+
+def proximity_raster(in_path, out_path, layer='', maxdist=20000, workers=1,
+                     tile_size=2048):
     """
-    Burns a shapefile into a raster (rasterize).
-    If Field is specified in layer settings, it burns a categorical value.
+    Creates a proximity raster form a rasterized shapefile.
+    Returns values in meters, up to maxdist, and proximity_far beyond it.
+    Distances are computed tile by tile (see proximity_tile), in parallel
+    if workers > 1.
 
     Parameters
     ----------
-    in_path : path to shapefile to rasterize.
-    out_path : path to new raster.
-    layer : name of the layer
-    settings : general settings from GENERAL_SETTINGS class.
-    base_path : path to base raster.
+    in_path : path to rasterized layer.
+    out_path : path to new proximity raster.
+    layer : TYPE, optional
+        Name of the layer. The default is ''.
+    maxdist : maximum distance in meters. The default is 20000.
+    workers : number of processes to compute tiles. The default is 1.
+    tile_size : size of tiles in pixels. The default is 2048.
 
     Returns
     -------
@@ -629,7 +1780,7 @@ def rasterize_shapefile(in_path, out_path, layer, settings, base_path):
 
     """
 
-    print('            Rasterizing ' + layer)
+    print('            Creating proximity raster ' + layer)
 
     # Search for pressure layer if exists
     out_exists = os.path.isfile(out_path)
@@ -637,111 +1788,127 @@ def rasterize_shapefile(in_path, out_path, layer, settings, base_path):
     # Continue if does not exist
     if not out_exists:
 
-        # Vector layer as a raster
-        clipped_vector = VECTOR(in_path)
-        clipped_layer = clipped_vector.layer
-
-        # Get field for rasterizing
-        try:
-            field = layers_settings[layer]['cat_field']
-        except KeyError:
-            field = None
-
-        # Is field exists, check if it'a string field
-        field_is_string = False
-        if field:
-            for i in clipped_vector.schema:
-                if i.GetName() == field:
-                    field_type = (i.GetFieldTypeName(i.GetType()))
-                    if field_type == 'String':
-                        field_is_string = True
+        # Proximity raster path
+        rasterized_raster = RASTER(in_path)
+        XSize, YSize = rasterized_raster.XSize, rasterized_raster.YSize
 
-        # If field is string, translate to numbers in a new field
-        if field_is_string:
+        # Create proximity raster and open a band. MAXDIST fits in UInt16
+        DataType = raster_dtypes['proximity'][0]
+        drv = gdal.GetDriverByName('GTiff')
+        proximity_ds = drv.Create(out_path, XSize, YSize,
+                                  1, gdal.GetDataTypeByName(DataType),
+                                  creation_options(DataType))
+        proximity_ds.SetGeoTransform(rasterized_raster.geotrans)
+        proximity_ds.SetProjection(rasterized_raster.projref)
+        proximity_bd = proximity_ds.GetRasterBand(1)
 
-            # Import scoring methods to assign an integer to land use categories
-            scoring_method = layers_settings[layer]['scoring']
-            scores_full = getattr(HF_scores, settings.scoring_template)
-            scores = scores_full[scoring_method]
+        # If maxdist is under the pixel size, only rasterized pixels are
+        # within it: the distance transform is not needed
+        min_res = min(rasterized_raster.resX, rasterized_raster.resY)
+        if maxdist < min_res:
+            print('               Presence only')
+            for window in block_windows(rasterized_raster):
+                targets = rasterized_raster.get_window(window) != 0
+                proximity = np.where(targets, 0, proximity_far)
+                proximity_bd.WriteArray(proximity.astype(np.uint16),
+                                        window[0], window[1])
+            rasterized_raster.close()
 
-            # Create new field
-            # field_name = ogr.FieldDefn('Use_int', ogr.OFTInteger)
-            field_name = ogr.FieldDefn('Use_int', ogr.OFTReal)
-            field_name.SetPrecision(3)
-            try:
-                clipped_layer.CreateField(field_name)
-                field_to_fill = True
-            except RuntimeError:
-                field_to_fill = False
-
-            if field_to_fill:
-
-                # Populate new field translating string to number categories
-                # loop through the input features
-                inFeature = clipped_layer.GetNextFeature()
-                while inFeature:
-                    value_int = None
-                    value_str = inFeature.GetField(field)
-                    for topic in scores['scores_by_categories']:
-                        if value_str in scores['scores_by_categories'][topic][1]:
-                            value_int = scores['scores_by_categories'][topic][0]
-
-                    # Silly value to catch missing values
-                    if value_int is None:
-                        print(f'Problem string {value_str}')
-                        value_int = 999
-                    inFeature.SetField('Use_int', value_int)
-                    clipped_layer.SetFeature(inFeature)
-                    inFeature = clipped_layer.GetNextFeature()
-
-        # Create a copy of base raster
-        drv = gdal.GetDriverByName('GTiff')
-        base_raster = RASTER(base_path)
-        rasterized_template = drv.CreateCopy(out_path,
-                                              base_raster.ds, strict=0)
-        rasterized_template = None
-
-        # Convert clipped raster's values to 0s and save
-        rasterized_raster = RASTER(out_path)
-        rasterized_array = rasterized_raster.get_array()
-        rasterized_array[rasterized_array<1000] = 0
-        rasterized_raster.bd.WriteArray(rasterized_array)
-        rasterized_raster.close()
-
-        # Rasterize vector layer to template raster
-        rasterized_raster = RASTER(out_path)
-        if field:
-            gdal.RasterizeLayer(rasterized_raster.ds,
-                                [1], clipped_layer,
-                                options=["ATTRIBUTE=Use_int"])
         else:
-            gdal.RasterizeLayer(rasterized_raster.ds, [1], clipped_layer,
-                                None, None,  # transformation info not needed
-                                [1],  # value to burn
-                                ['ALL_TOUCHED=TRUE']  # burn all pixels touched
-                                )
+            # Tiles with a halo that covers maxdist
+            halo = int(math.ceil(maxdist / min_res))
+            rasterized_raster.close()
+            jobs = [(in_path, (xoff, yoff, min(tile_size, XSize - xoff),
+                               min(tile_size, YSize - yoff)), halo, maxdist)
+                    for yoff in range(0, YSize, tile_size)
+                    for xoff in range(0, XSize, tile_size)]
+
+            # Compute proximity raster
+            executor = ProcessPoolExecutor(workers) if workers > 1 else None
+            if executor:
+                results = executor.map(proximity_tile, *zip(*jobs))
+            else:
+                results = (proximity_tile(*job) for job in jobs)
+            for window, proximity in results:
+                proximity_bd.WriteArray(proximity, window[0], window[1])
+            if executor:
+                executor.shutdown()
 
-        # Close everything
-        rasterized_raster.close()
-        compress(out_path)
-        base_raster.close()
-        clipped_vector.close()
+        # Close rasters
+        proximity_bd.ComputeStatistics(0)
+        proximity_ds = None
 
     else:
-        print(f'               {layer} was already rasterized')
+        print(f'               {layer} proximity raster existed already')
 
 
-def proximity_raster(in_path, out_path, layer=''):
+def vector_proximity_tile(tree, geotrans, window, maxdist):
     """
-    Creates a proximity raster form a rasterized shapefile.
-    Returns values in meters.
+    Proximity of the pixels of a tile to the geometries of a STRtree,
+    from the center of the pixels. Pixels touched by a geometry are 0, as
+    rasterized with all touched pixels. Pixels beyond maxdist are
+    proximity_far.
 
     Parameters
     ----------
-    in_path : path to rasterized layer.
+    tree : shapely.STRtree of the geometries.
+    geotrans : geotransform of the grid.
+    window : (xoff, yoff, xsize, ysize) of the tile in pixels.
+    maxdist : maximum distance in meters.
+
+    Returns
+    -------
+    proximity : uint16 array of the tile.
+
+    """
+
+    xoff, yoff, xsize, ysize = window
+    resX, resY = geotrans[1], -geotrans[5]
+    proximity = np.full((ysize, xsize), proximity_far, dtype=np.uint16)
+
+    # Coordinates of the centers of the pixels
+    xs = geotrans[0] + (xoff + np.arange(xsize) + 0.5) * resX
+    ys = geotrans[3] - (yoff + np.arange(ysize) + 0.5) * resY
+    xs, ys = np.meshgrid(xs, ys)
+    centers = shapely.points(xs.ravel(), ys.ravel())
+
+    # Nearest geometry up to maxdist, or up to the corners of the pixels to
+    # find the touched ones
+    half_diagonal = math.hypot(resX, resY) / 2
+    (pixels, _), distances = tree.query_nearest(
+        centers, max_distance=max(maxdist, half_diagonal),
+        return_distance=True, all_matches=False)
+    within = distances <= maxdist
+    proximity.flat[pixels[within]] = np.rint(distances[within])
+
+    # Pixels touched by a geometry
+    near = pixels[distances <= half_diagonal]
+    cells = shapely.box(xs.flat[near] - resX / 2, ys.flat[near] - resY / 2,
+                        xs.flat[near] + resX / 2, ys.flat[near] + resY / 2)
+    touched, _ = tree.query(cells, predicate='intersects')
+    proximity.flat[near[np.unique(touched)]] = 0
+
+    return proximity
+
+
+def vector_proximity_raster(in_path, out_path, base_path, layer='',
+                            maxdist=20000, tile_size=512):
+    """
+    Creates a proximity raster from the geometries of a reprojected layer,
+    without rasterizing it. Only the tiles within maxdist of a geometry are
+    computed (see vector_proximity_tile), the rest are proximity_far, so
+    time depends on the area around the features instead of the extent.
+    For sparse point and line layers (see use_vector_proximity).
+
+    Parameters
+    ----------
+    in_path : path to reprojected and clipped layer.
     out_path : path to new proximity raster.
+    base_path : path to base raster.
     layer : TYPE, optional
         Name of the layer. The default is ''.
+    maxdist : maximum distance in meters. The default is 20000.
+    tile_size : size of tiles in pixels. The default is 512.
 
     Returns
     -------
@@ -749,7 +1916,7 @@ def proximity_raster(in_path, out_path, layer=''):
 
     """
 
-    print('            Creating proximity raster ' + layer)
+    print('            Creating proximity raster from vector ' + layer)
 
     # Search for pressure layer if exists
     out_exists = os.path.isfile(out_path)
@@ -757,34 +1924,89 @@ def proximity_raster(in_path, out_path, layer=''):
     # Continue if does not exist
     if not out_exists:
 
-        # Proximity raster path
-        rasterized_raster = RASTER(in_path)
-        rasterized_bd = rasterized_raster.bd
+        # Geometries in a spatial index
+        geometries = gpd.read_file(in_path).geometry
+        geometries = geometries[geometries.notna() & ~geometries.is_empty]
+        tree = shapely.STRtree(np.asarray(geometries.values))
 
-        # Create proximity raster and open a band
-        drv = gdal.GetDriverByName('GTiff')
-        proximity_ds = drv.Create(out_path,
-                                  rasterized_raster.XSize,
-                                  rasterized_raster.YSize,
-                                  1, gdal.GetDataTypeByName('Int32'))
-        proximity_ds.SetGeoTransform(rasterized_raster.geotrans)
-        proximity_ds.SetProjection(rasterized_raster.projref)
+        # Proximity raster, far everywhere
+        base_grid = get_base_grid(base_path)
+        proximity_ds = create_empty_raster(out_path, base_grid,
+                                           kind='proximity')
         proximity_bd = proximity_ds.GetRasterBand(1)
-
-        # Compute proximity raster
-        gdal.ComputeProximity(rasterized_bd, proximity_bd, ['DISTUNITS=GEO', 'MAXDIST=20000'])
+        proximity_bd.Fill(proximity_far)
+
+        # Tiles within maxdist of a geometry
+        geotrans = base_grid.geotrans
+        resX, resY = geotrans[1], -geotrans[5]
+        for yoff in range(0, base_grid.YSize, tile_size):
+            for xoff in range(0, base_grid.XSize, tile_size):
+                window = (xoff, yoff,
+                          min(tile_size, base_grid.XSize - xoff),
+                          min(tile_size, base_grid.YSize - yoff))
+                tile = shapely.box(
+                    geotrans[0] + xoff * resX,
+                    geotrans[3] - (yoff + window[3]) * resY,
+                    geotrans[0] + (xoff + window[2]) * resX,
+                    geotrans[3] - yoff * resY)
+                if len(tree.query(tile, predicate='dwithin',
+                                  distance=maxdist)):
+                    proximity = vector_proximity_tile(tree, geotrans,
+                                                      window, maxdist)
+                    proximity_bd.WriteArray(proximity, xoff, yoff)
 
         # Close rasters
         proximity_bd.ComputeStatistics(0)
         proximity_ds = None
-        rasterized_raster.close()
 
     else:
         print(f'               {layer} proximity raster existed already')
 
 
+def use_vector_proximity(in_path, layer, settings):
+    """
+    True if the proximity raster of a layer is created from its geometries
+    (vector_proximity_raster) instead of rasterizing it: point and line
+    layers, rasterized as presence, of up to vector_proximity_features
+    features. Roads are always rasterized, as the times raster of indirect
+    pressures reads their rasterized layer.
+
+    Parameters
+    ----------
+    in_path : path to reprojected and clipped layer.
+    layer : Layer name of the pressure/dataset to prepare
+    settings : general settings from GENERAL_SETTINGS class.
+
+    Returns
+    -------
+    bool
+
+    """
+
+    if 'cat_field' in layers_settings[layer]:
+        return False
+
+    roads = {layer_roads
+             for purpose_layers in settings.purpose_layers.values()
+             for layer_roads in purpose_layers['pressures'].get(
+                 'Roads_Railways', {}).get('datasets', ())}
+    if layer in roads or \
+            layers_settings[layer]['scoring'].startswith('road_scores'):
+        return False
+
+    vector = ogr.Open(in_path)
+    vector_layer = vector.GetLayer()
+    n_features = vector_layer.GetFeatureCount()
+    geometry_type = ogr.GeometryTypeToName(
+        ogr.GT_Flatten(vector_layer.GetGeomType()))
+    vector = None
+
+    return (n_features <= vector_proximity_features
+            and ('Point' in geometry_type or 'Line' in geometry_type))
+
+
 def create_proximity_raster(layer, settings, base_path, final_path,
-                            scoring_template, main_folder, res):
+                            scoring_template, main_folder, res, workers=1):
     """
     Controls the process of creating a proximity raster.
     It will reproject, clip, rasterize and create the proximity raster.
@@ -797,6 +2019,7 @@ def create_proximity_raster(layer, settings, base_path, final_path,
     final_path : path for proximity raster.
     scoring_template : Name of the scoring template from HF_scores. E.g. 'GHF'.
     main_folder : Name of folder in root for all analysis.
+    workers : number of processes to compute tiles. The default is 1.
 
     Returns
     -------
@@ -816,15 +2039,26 @@ def create_proximity_raster(layer, settings, base_path, final_path,
         out_path = f'{main_folder}HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_{scoring_template}_clip_proj.gpkg'
         reproject_shapefile(in_path, out_path, layer, settings)
 
-        # Rasterize reprojected and clipped shapefile
+        # Proximity up to the distance that changes scores
+        maxdist = proximity_maxdist(scoring_template,
+                                    layers_settings[layer]['scoring'])
+
+        # Sparse layers: proximity from their geometries
         in_path = out_path
+        if use_vector_proximity(in_path, layer, settings):
+            vector_proximity_raster(in_path, final_path, base_path,
+                                    layer=layer, maxdist=maxdist)
+            return
+
+        # Rasterize reprojected and clipped shapefile
         out_path = f'{main_folder}/HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_{res}m_rasterized.tif'
         rasterize_shapefile(in_path, out_path, layer, settings, base_path)
 
         # Create proximity raster
         in_path = out_path
         out_path = final_path
-        proximity_raster(in_path, out_path, layer=layer)
+        proximity_raster(in_path, out_path, layer=layer, maxdist=maxdist,
+                         workers=workers)
 
     else:
         print(f'            {layer} already prepared')
@@ -880,288 +2114,535 @@ def get_geo_coords(pixel, GT):
     return (X_geo, Y_geo)
 
 
-def get_random_elements(lst, n):
-    if n > len(lst):
-        raise ValueError("The specified number of elements is greater than the length of the list.")
-
-    random_indices = random.sample(range(len(lst)), n)
-    random_elements = [lst[i] for i in random_indices]
-    return random_elements
-
-def get_source_pixels(built_path, sources_path):
-
-    built_raster = RASTER(built_path)
-    built_array = built_raster.get_array()
-
-    rows = built_raster.YSize - 1
-    cols = built_raster.XSize - 1
-
-    track_built = copy.deepcopy(built_array)
-
-    source_pixels_list = []
-
-    for row in range(0, rows):
-        for col in range(0, cols):
-            if (track_built[row, col] != -2) and (built_array[row, col] == 1):
+def get_cluster_sources(cluster_rows, cluster_cols, rng):
+    """
+    Selects source pixels of a cluster of built pixels.
+    Clusters of 1 pixel are ignored, clusters under 50 pixels get 1 source
+    pixel (the middle one), then 1 every 50 pixels until 500 pixels,
+    1 every 100 until 5000 pixels and 1 every 1000 pixels above that.
 
-                track_built[row, col] = -2
-                cluster = [(row, col)]
-                big_pixels = [(row, col)]
+    Parameters
+    ----------
+    cluster_rows, cluster_cols : arrays of rows and columns of the cluster.
+    rng : numpy random Generator, seeded for reproducible results.
 
-                while big_pixels:
+    Returns
+    -------
+    rows, cols : arrays of rows and columns of source pixels.
 
-                    small_pixels = []
+    """
 
-                    for big_neighb in big_pixels:
+    len_ = len(cluster_rows)
+    if len_ <= 1:
+        return cluster_rows[:0], cluster_cols[:0]
 
-                        i = big_neighb[0]
-                        j = big_neighb[1]
+    if len_ < 50:
+        middle_index = int(np.floor(len_/2))
+        return cluster_rows[middle_index:middle_index+1], \
+            cluster_cols[middle_index:middle_index+1]
 
-                        neighbs = {(i + 1, j): 'direct',
-                                    (i - 1, j): 'direct',
-                                    (i, j + 1): 'direct',
-                                    (i, j - 1): 'direct',
-                                    (i + 1, j + 1): 'diagonal',
-                                    (i + 1, j - 1): 'diagonal',
-                                    (i - 1, j + 1): 'diagonal',
-                                    (i - 1, j - 1): 'diagonal', }
+    #  get 1 every 50 until 500 pixels, then every 100
+    div = 50 if len_<500 else 100
+    if len_>5000: div = 1000
+    n = int(len_/div)
+    random_indices = rng.choice(len_, n, replace=False)
+    return cluster_rows[random_indices], cluster_cols[random_indices]
 
-                        for n in neighbs:
 
-                            try:
-                                cond1 = track_built[n[0], n[1]] != -2
-                                cond2 = built_array[n[0], n[1]] == 1
-                            except IndexError:
-                                cond1 = False
-                                cond2 = False
+def get_source_pixels(built_path, sources_path, seed=0):
+    """
+    Gets source points for the cost surface from clusters of built pixels.
+    Clusters are 8-connected components labelled with scipy.ndimage and
+    the points are written to a geopackage.
 
-                            if cond1 and cond2:
-                                small_pixels.append((n[0], n[1]))
-                                cluster.append((n[0], n[1]))
-                                track_built[n[0], n[1]] = -2
+    Parameters
+    ----------
+    built_path : path to raster of built areas (1 for built).
+    sources_path : path to new geopackage of source points.
+    seed : seed of the random generator used to sample large clusters.
+    The default is 0.
 
-                    big_pixels = list(set(small_pixels))
+    Returns
+    -------
+    None.
 
-                unique_pixels = list(set(cluster))
+    """
 
-                # Append a source pixel if it's a cluster of more than 1 pixel
-                len_ = len(unique_pixels)
-                if len_>1:
-                    # Get number of source pixels according to size of cluster
-                    if len_<50: # get 1
-                        middle_index= int(np.floor(len_/2))
-                        source_pixel = cluster[middle_index]
-                        source_pixels_list.append(source_pixel)
-                    else:
-                        #  get 1 every 50 until 500 pixels, then every 100
-                        div = 50 if len_<500 else 100
-                        if len_>5000: div = 1000
-                        n = int(len_/div)
-                        source_pixel = get_random_elements(unique_pixels, n)
-                        for i in source_pixel: source_pixels_list.append(i)
+    built_raster = RASTER(built_path)
+    built_array = built_raster.get_array()
 
+    # Label clusters of built pixels, including diagonal neighbours
+    labels, num_clusters = ndimage.label(built_array == 1,
+                                         structure=np.ones((3, 3), dtype=int),
+                                         output=np.int32)
+    built_raster.array, built_array = None, None
+    cluster_sizes = np.bincount(labels.ravel(), minlength=num_clusters + 1)
+
+    rng = np.random.default_rng(seed)
+    source_rows, source_cols = [], []
+    for label, slices in enumerate(ndimage.find_objects(labels), start=1):
+
+        # Clusters of 1 pixel don't have source pixels
+        if slices is None or cluster_sizes[label] <= 1:
+            continue
+
+        rows, cols = np.nonzero(labels[slices] == label)
+        rows, cols = get_cluster_sources(rows + slices[0].start,
+                                         cols + slices[1].start, rng)
+        source_rows.append(rows)
+        source_cols.append(cols)
+
+    labels = None
+    if source_rows:
+        source_rows = np.concatenate(source_rows)
+        source_cols = np.concatenate(source_cols)
     GT = built_raster.geotrans
-    source_pixels_list = [get_geo_coords(pixel, GT) for pixel in source_pixels_list]
+    X_geo, Y_geo = get_geo_coords((np.asarray(source_rows),
+                                   np.asarray(source_cols)), GT)
 
     # Get authority of projection from base raster and close
     crs_authority = built_raster.crs_authority
     built_raster.close()
-    built_array, track_built = None, None
-
-    # set up the shapefile driver
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-
-    # create the data source
-    sources_path_shp = sources_path.replace('gpkg','shp')
-    data_source = driver.CreateDataSource(sources_path_shp)
 
-    # create the spatial reference, WGS84
+    # create the spatial reference from the built raster
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(int(crs_authority))
 
-    # create the layer
+    # create the geopackage and the layer
+    driver = ogr.GetDriverByName("GPKG")
+    data_source = driver.CreateDataSource(sources_path)
     layer = data_source.CreateLayer("sources", srs, ogr.wkbPoint)
-
-    # Add the fields we're interested in
     layer.CreateField(ogr.FieldDefn("Id", ogr.OFTInteger))
+    layer_defn = layer.GetLayerDefn()
 
-    # Process the text file and add the attributes and features to the shapefile
-    for count, pixel in enumerate(source_pixels_list):
-        # create the feature
-        feature = ogr.Feature(layer.GetLayerDefn())
-        # Set the attributes using the values from the delimited text file
+    # Add all points in one transaction
+    layer.StartTransaction()
+    for count, (x, y) in enumerate(zip(X_geo, Y_geo)):
+        feature = ogr.Feature(layer_defn)
         feature.SetField("Id", count)
-        # create the WKT for the feature using Python string formatting
-        wkt = "POINT(%f %f)" %  (pixel[0], pixel[1])
-        # Create the point from the Well Known Txt
-        point = ogr.CreateGeometryFromWkt(wkt)
-        # Set the feature geometry using the point
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(float(x), float(y))
         feature.SetGeometry(point)
-        # Create the feature in the layer (shapefile)
         layer.CreateFeature(feature)
-        # Dereference the feature
         feature = None
+    layer.CommitTransaction()
 
     # Save and close the data source
     data_source = None
 
-    # Convert to geopackage and remove shapefile
-    command = f'ogr2ogr -f GPKG "{sources_path}" "{sources_path_shp}"'
-    os.system(command)
-    driver.DeleteDataSource(sources_path_shp)
 
+def cost_distance_window(costs, seeds_rows, seeds_cols, seeds_costs,
+                         max_cost=np.inf):
+    """
+    Calculates least cumulative costs within a window, starting from seed
+    pixels that already have a cumulative cost (0 for sources).
+    Travel between neighbours (including diagonals) costs the mean cost of
+    both pixels times the distance, as skimage.graph.MCP_Geometric.
+    Negative or non finite costs are impassable.
 
-def find_location_cells(destinations, cs):
-    """find cell indices of destination locations
     Parameters
     ----------
-    destinations: geopandas data frame containing locations
-    cs: costsurface
-    """
-
-    print('               Finding locations', datetime.now().strftime("%H:%M:%S"))
-    start_cells = []
+    costs : 2-D array of costs to cross each pixel.
+    seeds_rows, seeds_cols : rows and columns of seed pixels in the window.
+    seeds_costs : cumulative costs of seed pixels.
+    max_cost : costs are not propagated beyond this value. The default is
+    np.inf.
 
-    # Loop over all destination locations
-    longs = cs.get_index('x')
-    lats = cs.get_index('y')
-
-    for location in destinations['geometry']:
-        idx_i = longs.get_indexer([location.x], method='nearest')[0]
-        idx_j = lats.get_indexer([location.y], method='nearest')[0]
-        start_cells.append((0, idx_j, idx_i))
-
-    return start_cells
-
-
-def compute_cost_path(cost_raster_path, starting_points_gpkg_path, output_raster_path,
-                      poly_mask=None):
-
-    '''
-    https://tretherington.blogspot.com/2017/01/least-cost-modelling-with-python-using.html
-    '''
+    Returns
+    -------
+    cumulative : array of cumulative costs. np.inf where not reached.
 
-    with rxr.open_rasterio(cost_raster_path, masked=True) as costsurface:
+    """
 
-        if not poly_mask:
-            destinations = gpd.read_file(
-                starting_points_gpkg_path,#)
-                bbox=costsurface.rio.bounds())
-        else:
-            # Read polygon from geopackage
-            # poly_gpkg_path = "path/to/polygon.gpkg"
-            poly_gdf = gpd.read_file(poly_mask)
+    costs = np.asarray(costs, dtype=np.float64)
+    rows, cols = costs.shape
+    num = rows * cols
+    passable = np.isfinite(costs) & (costs >= 0)
+    nodes = np.arange(num).reshape(rows, cols)
+
+    # Edges to the right, down and both diagonals down. The graph is used
+    # as undirected, so each pair of neighbours appears once
+    starts, ends, weights = [], [], []
+    for a, b, dist in (
+            ((slice(None), slice(None, -1)), (slice(None), slice(1, None)), 1),
+            ((slice(None, -1), slice(None)), (slice(1, None), slice(None)), 1),
+            ((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None)), np.sqrt(2)),
+            ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1)), np.sqrt(2)),
+            ):
+        goods = passable[a] & passable[b]
+        starts.append(nodes[a][goods])
+        ends.append(nodes[b][goods])
+        weights.append(0.5 * (costs[a][goods] + costs[b][goods]) * dist)
+
+    # A virtual node joins all seeds with their cumulative cost
+    seeds = seeds_rows * cols + seeds_cols
+    seeds_goods = passable.ravel()[seeds]
+    starts.append(np.full(seeds_goods.sum(), num))
+    ends.append(seeds[seeds_goods])
+    weights.append(np.asarray(seeds_costs, dtype=np.float64)[seeds_goods])
+
+    graph = csr_matrix((np.concatenate(weights),
+                        (np.concatenate(starts), np.concatenate(ends))),
+                       shape=(num + 1, num + 1))
+    starts, ends, weights = None, None, None
+    cumulative = dijkstra(graph, directed=False, indices=num,
+                          limit=max_cost)[:num]
+
+    return cumulative.reshape(rows, cols)
+
+
+def cost_tile(cost_raster_path, window, sources, seeds, max_cost):
+    """
+    Reads a window of the cost raster and calculates cumulative costs from
+    sources and seeds inside it. Used by compute_cost_path, also in
+    parallel processes.
 
-            # Read points from geopackage
-            # points_gpkg_path = "path/to/points.gpkg"
-            points_gdf = gpd.read_file(starting_points_gpkg_path)
+    Parameters
+    ----------
+    cost_raster_path : path to cost raster.
+    window : (row_off, col_off, height, width) of the tile with its halo.
+    sources : (rows, cols) of sources in the window.
+    seeds : (rows, cols, costs) of seeds in the window.
+    max_cost : maximum cumulative cost.
 
-            # Spatial join to get points within polygon
-            # destinations = gpd.sjoin(points_gdf, poly_gdf, op="within")
-            destinations = gpd.sjoin(points_gdf, poly_gdf, predicate="within")
+    Returns
+    -------
+    window : same window.
+    cumulative : array of cumulative costs of the window.
 
-        start_cells = find_location_cells(destinations, costsurface)
+    """
 
-        del destinations
+    row_off, col_off, height, width = window
+    with rasterio.open(cost_raster_path) as src:
+        costs = src.read(1, window=Window(col_off, row_off, width, height),
+                         masked=True)
+    costs = costs.astype(np.float64).filled(-9999)
 
-        print('               Getting cost surface', datetime.now().strftime("%H:%M:%S"))
+    rows = np.concatenate([sources[0], seeds[0]]).astype(np.intp)
+    cols = np.concatenate([sources[1], seeds[1]]).astype(np.intp)
+    seeds_costs = np.concatenate([np.zeros(len(sources[0])), seeds[2]])
 
-        # find costs algorithm does not deal with np.NaN so change these
-        # to -9999 in cost surface any negative values are ignored
-        nd = -9999
-        costsurface = costsurface.fillna(nd)
+    return window, cost_distance_window(costs, rows, cols, seeds_costs,
+                                        max_cost)
 
-        # From the cost-surface create a 'landscape graph' object which can then be
-        # analysed using least-cost modelling
-        lg = graph.MCP_Geometric(costsurface.values, sampling=None)
 
-        costs = xr.zeros_like(costsurface, dtype=np.float32)
+@instrumented
+def compute_cost_path(cost_raster_path, starting_points_gpkg_path,
+                      output_raster_path, max_cost=np.inf, tile_size=1024,
+                      halo=128, workers=1):
+    """
+    Calculates the least cumulative cost from the starting points to every
+    pixel of the cost raster, tile by tile.
+    Each tile is computed with a halo around it, seeded with the costs
+    already found at the edges of the halo, and tiles are computed again
+    until no cost changes. The result is the same as computing the whole
+    raster at once, with memory bounded by the size of the tiles.
+    Cumulative costs are stored in a temporary memory-mapped file.
+    Impassable pixels (NoData or negative costs) are written as NoData.
+    Passable pixels that no starting point reaches are written as np.inf,
+    so indirect scoring gives them 0. Before the tiled engine they were
+    written as NoData, which indirect scoring turned into its maximum
+    score.
 
-        # Calculate the least-cost distance from the start cell to all other cells
-        # [0] is returning the cumulative costs rather than the traceback
-        costs.values = lg.find_costs(starts=start_cells)[0]
+    Parameters
+    ----------
+    cost_raster_path : path to raster of costs to cross each pixel.
+    starting_points_gpkg_path : path to geopackage of starting points.
+    output_raster_path : path for raster of cumulative costs.
+    max_cost : costs are not propagated beyond this value, pixels further
+    away are written as np.inf. The default is np.inf.
+    tile_size : size of tiles in pixels. The default is 1024.
+    halo : pixels added to each side of the tiles. The default is 128.
+    workers : number of processes to compute tiles. The default is 1.
 
-        del lg
-        costs = xr.where(np.isfinite(costs), costs, nd)
+    Returns
+    -------
+    None.
 
+    """
 
-    print('               Writing', datetime.now().strftime("%H:%M:%S"))
+    nd = -9999
     with rasterio.open(cost_raster_path) as src:
-        profile=src.profile
-
-    costs = np.asarray(costs)
-    with rasterio.open(output_raster_path, 'w', **profile) as dst:
-        dst.nodata = nd
-        dst.write(costs)
-
-
-def split_raster(input_raster, output_path, polygon, name):
-
-    # # Get list of polygon layers
-
-    input_gdf = gpd.read_file(polygon)
+        profile = src.profile
+        transform = src.transform
+        height, width = src.height, src.width
+        bounds = src.bounds
+
+    # Pixels of starting points
+    destinations = gpd.read_file(starting_points_gpkg_path, bbox=tuple(bounds))
+    cols, rows = ~transform * (destinations.geometry.x.values,
+                               destinations.geometry.y.values)
+    rows, cols = np.floor(rows).astype(np.intp), np.floor(cols).astype(np.intp)
+    goods = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    rows, cols = rows[goods], cols[goods]
+    destinations = None
+
+    # Tiles with their halos
+    tiles = {}
+    for tile_row in range(0, height, tile_size):
+        for tile_col in range(0, width, tile_size):
+            row_off, col_off = max(0, tile_row - halo), max(0, tile_col - halo)
+            row_end = min(height, tile_row + tile_size + halo)
+            col_end = min(width, tile_col + tile_size + halo)
+            tiles[(tile_row, tile_col)] = (row_off, col_off,
+                                           row_end - row_off, col_end - col_off)
+
+    def tile_sources(window):
+        row_off, col_off, h, w = window
+        inside = (rows >= row_off) & (rows < row_off + h) & \
+            (cols >= col_off) & (cols < col_off + w)
+        return rows[inside] - row_off, cols[inside] - col_off
+
+    def tile_seeds(window):
+        # Costs already found on the edges of the window
+        row_off, col_off, h, w = window
+        frame = np.zeros((h, w), dtype=bool)
+        frame[0, :], frame[-1, :], frame[:, 0], frame[:, -1] = True, True, True, True
+        frame_costs = np.where(frame, cumulative[row_off:row_off + h,
+                                                 col_off:col_off + w], np.inf)
+        seeds_rows, seeds_cols = np.nonzero(np.isfinite(frame_costs))
+        return seeds_rows, seeds_cols, frame_costs[seeds_rows, seeds_cols]
+
+    def overlap(window1, window2):
+        return window1[0] < window2[0] + window2[2] and \
+            window2[0] < window1[0] + window1[2] and \
+            window1[1] < window2[1] + window2[3] and \
+            window2[1] < window1[1] + window1[3]
+
+    # Tiles whose windows can overlap a tile's window: those within
+    # reach tiles in rows and columns
+    reach = -(-2 * halo // tile_size)
+
+    def neighbours(tile):
+        tile_row, tile_col = tile
+        for i in range(-reach, reach + 1):
+            for j in range(-reach, reach + 1):
+                other = (tile_row + i * tile_size, tile_col + j * tile_size)
+                if (i or j) and other in tiles:
+                    yield other
+
+    cumulative_path = output_raster_path.replace('.tif', '_cumulative.dat')
+    cumulative = np.memmap(cumulative_path, dtype=np.float64, mode='w+',
+                           shape=(height, width))
+    cumulative[:] = np.inf
+
+    # Start with tiles that have starting points
+    to_compute = [tile for tile, window in tiles.items()
+                  if len(tile_sources(window)[0])]
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    num_pass = 0
+
+    while to_compute:
+
+        num_pass += 1
+        print(f'               Pass {num_pass}: {len(to_compute)} tiles',
+              datetime.now().strftime("%H:%M:%S"))
+        jobs = [(cost_raster_path, tiles[tile], tile_sources(tiles[tile]),
+                 tile_seeds(tiles[tile]), max_cost) for tile in to_compute]
+        if executor:
+            results = executor.map(cost_tile, *zip(*jobs))
+        else:
+            results = (cost_tile(*job) for job in jobs)
+
+        # Keep the lowest costs and compute again the neighbours of
+        # tiles with changes in their common area
+        changed_tiles = set()
+        for tile, (window, tile_costs) in zip(to_compute, results):
+            row_off, col_off, h, w = window
+            current = cumulative[row_off:row_off + h, col_off:col_off + w]
+            changed = tile_costs < current
+            if not changed.any():
+                continue
+            current[changed] = tile_costs[changed]
+            for other_tile in neighbours(tile):
+                other = tiles[other_tile]
+                if overlap(window, other):
+                    r0, c0 = max(row_off, other[0]), max(col_off, other[1])
+                    r1 = min(row_off + h, other[0] + other[2])
+                    c1 = min(col_off + w, other[1] + other[3])
+                    if changed[r0 - row_off:r1 - row_off,
+                               c0 - col_off:c1 - col_off].any():
+                        changed_tiles.add(other_tile)
+        to_compute = sorted(changed_tiles)
+
+    if executor:
+        executor.shutdown()
 
-    # Clip raster with geopandas GeoDataFrame
-    clipped_raster, clipped_transform = \
-        mask(input_raster, input_gdf.geometry,crop=True,indexes=1,all_touched=False)
+    print('               Writing', datetime.now().strftime("%H:%M:%S"))
+    profile.update(dtype=rasterio.float32, nodata=nd, count=1,
+                   **creation_options('Float32', False))
+    with rasterio.open(cost_raster_path) as src, \
+            rasterio.open(output_raster_path, 'w', **profile) as dst:
+        for _, window in dst.block_windows(1):
+            costs = src.read(1, window=window, masked=True)
+            tile_costs = cumulative[window.row_off:window.row_off + window.height,
+                                    window.col_off:window.col_off + window.width]
+            impassable = np.ma.getmaskarray(costs) | \
+                ~(costs.data.astype(np.float64) >= 0)
+            dst.write(np.where(impassable, nd, tile_costs).astype(np.float32),
+                      1, window=window)
+
+    # Remove temporary file of cumulative costs
+    current, tile_costs, cumulative = None, None, None
+    os.remove(cumulative_path)
+
+
+def get_river_speeds_table():
+    """
+    Builds the lookup table of river speeds from HF_scores, indexed by the
+    elevation and slope ranges. The last row and column are for values
+    outside the ranges of the table.
 
-    # Compute output profile
-    output_profile = input_raster.profile.copy()
-    output_profile.update({
-        "width": clipped_raster.shape[1],
-        "height": clipped_raster.shape[0],
-        "transform": clipped_transform
-    })
+    Returns
+    -------
+    table : 2-D array of speeds (km/h).
 
-    # Write output raster
-    with rasterio.open(output_path, "w", **output_profile) as output_raster:
-        output_raster.write(clipped_raster, 1)
+    """
 
+    speeds = np.array(HF_scores.River_speeds, dtype=np.float64)
+    rows, cols = speeds.shape
+    table = np.empty((rows + 1, cols + 1), dtype=np.float64)
+    table[:rows, :cols] = speeds
+    table[:rows, cols] = HF_scores.River_speed_out_slope
+    table[rows, :] = HF_scores.River_speed_out_elevation
 
-def merge_rasters(rasters_to_merge, final_path):
-    
-    print('   Merging', datetime.now().strftime("%H:%M:%S"))
+    return table
 
-    # # List of input rasters to merge
-    for raster_path in rasters_to_merge:
 
+def get_speeds(base, nd, slope, flooded, crops, elevation, rivers, coast,
+               roads, built, river_speeds, ave_walking=4):
+    """
+    Calculates speeds (km/h) from arrays of the same window. Conditions are
+    applied in order, so later ones have priority: terrain, flooded areas,
+    crops, rivers, coast, roads (level 3 to 1) and built areas.
 
-        with rasterio.open(raster_path, 'r+') as src:
-            nodata_value = src.nodata 
-            new_nodata_value = -9999
-            data = src.read(1)
+    Parameters
+    ----------
+    base : array of base raster, or mask of the study area (True inside).
+    nd : NoData value of base raster.
+    slope, flooded, crops, elevation, rivers, coast, built : arrays.
+    roads : arrays of road levels 3, 2 and 1, or None if not available.
+    river_speeds : lookup table from get_river_speeds_table.
+    ave_walking : average walking speed in km/h. The default is 4.
 
-            # Replace nodata pixel values with a new value
-            data[~np.isfinite(data)] = new_nodata_value
+    Returns
+    -------
+    speed_ar : array of speeds.
 
-            # Write the modified data to the original raster
-            src.write(data, 1)
+    """
 
+    slope = np.where(slope <= 1.8, 1.8, slope) #  Minimum slope measured
+    slope = np.where(slope > 1000, 1000, slope).astype(int) #  Maximum slope considered
+    flooded = flooded.astype(int)
+    terrain = -0.975931*np.log(slope) + 6.761258
+    speed_ar = np.where(base != 1, nd,
+        np.where(flooded == 2, .5*terrain,
+        np.where((flooded == 0)  | (flooded == 1), terrain,
+                 ave_walking)))
+
+    speed_ar = np.where(crops == 1,
+                        10.560326*np.power(slope,-0.199553), speed_ar)
+
+    # Rivers from lookup table of elevation and slope ranges
+    elevation = elevation.astype(int)
+    elevation[elevation<0] = 0
+    cols = river_speeds.shape[1] - 1
+    elev_idx = np.digitize(elevation, HF_scores.River_elevation_limits, right=True)
+    slope_idx = np.digitize(slope, HF_scores.River_slope_limits, right=True)
+    slope_idx[slope < 0] = cols
+    speed_ar = np.where(rivers == 1,
+                        river_speeds[elev_idx, slope_idx], speed_ar)
+
+    speed_ar = np.where(coast == 1, 20, speed_ar)
+    for roads_level, speed in zip(roads, (30, 40, 60)):
+        if roads_level is not None:
+            speed_ar = np.where(roads_level == 1, speed, speed_ar)
+    speed_ar = np.where(built == 1, 0, speed_ar)
+
+    # If a value is negative (happens on edges with voids of data),
+    # change to 4 as average walking speed
+    speed_ar[speed_ar<0] = ave_walking
+
+    return speed_ar
+
+
+def create_times_raster(times_path, base_path, flooded_path, crops_path,
+                        elev_path, slope_path, rivers_path, coast_path,
+                        built_path, roads_paths):
+    """
+    Creates the raster of times (in 10 seconds) to cross each pixel from
+    the speeds of each condition. All inputs are read and the times raster
+    is written window by window in a single pass.
 
-    # Merge rasters by minimum value
-    merged, merged_transform = merge(rasters_to_merge,method="min")
-    merged[merged==new_nodata_value] = nodata_value
+    Parameters
+    ----------
+    times_path : path for the new times raster.
+    base_path : path to base raster.
+    flooded_path, crops_path, elev_path, slope_path, rivers_path,
+    coast_path, built_path : paths to prepared rasters of each condition.
+    roads_paths : paths to rasterized roads of levels 3, 2 and 1. None if
+    a level is not available.
 
-    # Compute output profile
-    output_profile = rasterio.open(rasters_to_merge[0]).profile.copy()
-    output_profile.update({
-        "width": merged.shape[2],
-        "height": merged.shape[1],
-        "transform": merged_transform,
-        "nodata": nodata_value,     # Ensure the nodata value is set
-        "BIGTIFF": "YES"            # Enable BigTIFF for large files
-    })
+    Returns
+    -------
+    None.
 
-    # Write output raster
-    with rasterio.open(final_path, "w", **output_profile) as output_raster:
-        output_raster.write(merged[0,:,:], 1)
+    """
 
+    base_grid = get_base_grid(base_path)
+    nd = base_grid.nodata
+    conditions = {name: RASTER(path) for name, path in (
+        ('slope', slope_path), ('flooded', flooded_path),
+        ('crops', crops_path), ('elevation', elev_path),
+        ('rivers', rivers_path), ('coast', coast_path),
+        ('built', built_path))}
+    roads_rasters = [RASTER(path) if path else None for path in roads_paths]
+    river_speeds = get_river_speeds_table()
+
+    # Change speeds to time that takes to cross each pixel horizontally
+    # or vertically
+    xdist = base_grid.resX #  m
+    ydist = base_grid.resY #  m
+    diredist = (xdist + ydist) / 2
+
+    times_ds = create_empty_raster(times_path, base_grid, kind='times')
+    times_bd = times_ds.GetRasterBand(1)
+    times_nd = times_bd.GetNoDataValue()
+
+    for window in base_grid.windows():
+        arrays = {name: raster.get_window(window)
+                  for name, raster in conditions.items()}
+        roads = [raster.get_window(window) if raster else None
+                 for raster in roads_rasters]
+        speed_ar = get_speeds(base_grid.get_mask_window(window), nd,
+                              arrays['slope'], arrays['flooded'],
+                              arrays['crops'], arrays['elevation'],
+                              arrays['rivers'], arrays['coast'], roads,
+                              arrays['built'], river_speeds)
+
+        # Change only if there is a value of speed
+        goods = ~np.logical_or(speed_ar == nd, speed_ar == 0)
+        # Multiplying by 36 to calculate times in 10s
+        # (or speed are exagerated 10 times)
+        # allows to keep one extra digit with ushort type
+        speed_ar[goods] = np.divide(diredist*36, speed_ar[goods]).astype(int)
+        times_ar = np.where(speed_ar == nd, times_nd,
+                            np.clip(speed_ar, 0, times_nd - 1))
+        times_bd.WriteArray(times_ar.astype(np.uint16), window[0], window[1])
+        del arrays, roads, speed_ar, goods, times_ar
+
+    # Close everything
+    times_bd.ComputeStatistics(0)
+    times_bd, times_ds = None, None
+    for raster in list(conditions.values()) + roads_rasters:
+        if raster:
+            raster.close()
 
 
 def create_proximity_raster_from_pixels(layer, year, settings, base_path,
                                         final_path, scoring_template, purpose,
                                         results_folder, main_folder, res,
-                                        scoring_method, multitemp):
+                                        scoring_method, multitemp, workers=1):
     """
     Controls the creation of a raster of proximity from human influenced
     sections of rivers.
@@ -1170,7 +2651,7 @@ def create_proximity_raster_from_pixels(layer, year, settings, base_path,
     It propagates the distance from this contact points up and dowm, up to a
     maximum distance.
     It creates a proximity raster from these sections of human influenced
-    rivers.
+    rivers. Tiles of costs are computed in workers processes.
     """
 
     # Prepare in and out names
@@ -1200,15 +2681,17 @@ def create_proximity_raster_from_pixels(layer, year, settings, base_path,
             # command = f'gdalmanage copy  "{in_path}" "{crops_path}"'
             # os.system(command)
             
-            shutil.copy2(in_path, crops_path)
-            
-            
-            crops_raster = RASTER(crops_path)
-            crops_array = crops_raster.get_array()
-            results_array = np.where((6 > crops_array) & (crops_array >= 5),1,0)
-            crops_raster.bd.WriteArray(results_array)
-            crops_raster.close()
-            compress(crops_path)
+            land_cover_raster = RASTER(in_path)
+            crops_ds = create_empty_raster(crops_path, land_cover_raster,
+                                           kind='mask')
+            crops_bd = crops_ds.GetRasterBand(1)
+            for window in block_windows(land_cover_raster):
+                crops_array = land_cover_raster.get_window(window)
+                results_array = np.where((6 > crops_array) & (crops_array >= 5),1,0)
+                crops_bd.WriteArray(results_array, window[0], window[1])
+            crops_bd.ComputeStatistics(0)
+            crops_bd, crops_ds = None, None
+            land_cover_raster.close()
             crops_array, results_array = None, None
             del crops_array, results_array
 
@@ -1223,14 +2706,17 @@ def create_proximity_raster_from_pixels(layer, year, settings, base_path,
             # command = f'gdalmanage copy  "{in_path}" "{built_path}"'
             # os.system(command)
             
-            shutil.copy2(in_path, built_path)
-            
-            built_raster = RASTER(built_path)
-            built_array = built_raster.get_array()
-            results_array = np.where((15 > built_array) & (built_array >= 6),1,0)
-            built_raster.bd.WriteArray(results_array)
-            built_raster.close()
-            compress(built_path)
+            built_env_raster = RASTER(in_path)
+            built_ds = create_empty_raster(built_path, built_env_raster,
+                                           kind='mask')
+            built_bd = built_ds.GetRasterBand(1)
+            for window in block_windows(built_env_raster):
+                built_array = built_env_raster.get_window(window)
+                results_array = np.where((15 > built_array) & (built_array >= 6),1,0)
+                built_bd.WriteArray(results_array, window[0], window[1])
+            built_bd.ComputeStatistics(0)
+            built_bd, built_ds = None, None
+            built_env_raster.close()
             results_array, built_array = None, None
 
         # Get rivers raster
@@ -1296,133 +2782,10 @@ def create_proximity_raster_from_pixels(layer, year, settings, base_path,
         if not exists:
 
             print('            Calculating times surface')
-            ave_walking = 4 #  average walking speed in km/h
-
-            # Calculate speed based on conditions
-            # print('flooded t')
-            base_raster = RASTER(base_path)
-            base_array = base_raster.get_array()
-            nd = base_raster.nodata
-            slope = RASTER(slope_path).get_array()
-            slope[slope<=1.8] = 1.8 #  Minimum slope measured
-            slope[slope>1000] = 1000 #  Maximum slope considered
-            slope = slope.astype(int)
-            flooded = RASTER(flooded_path).get_array().astype(int)
-            speed_ar = np.where(base_array != 1, nd,
-                np.where(flooded == 2, .5*(-0.975931*np.log(slope) + 6.761258),
-                np.where((flooded == 0)  | (flooded == 1) , -0.975931*np.log(slope) + 6.761258,
-                         ave_walking)))
-            RASTER(flooded_path).close()
-            base_raster.close()
-            flooded, base_array = None, None
-
-            # print('crops t')
-            crops = RASTER(crops_path).get_array().astype(int)
-            speed_ar = np.where(crops == 1, 10.560326*np.power(slope,-0.199553),speed_ar)
-            RASTER(crops_path).close()
-            crops = None
-
-            # print('rivers t')
-            elevation = RASTER(elev_path).get_array().astype(int)
-            elevation[elevation<0] = 0
-            rivers = RASTER(rivers_path).get_array().astype(int)
-
-            # speed_ar()
-            speed_ar[np.where((rivers==1) & ((0>slope) | (slope>1000)))] = 1000
-            speed_ar[np.where((rivers==1) & ((0>elevation) | (elevation>10000)))] = 5000,
-            speed_ar[np.where((rivers==1) & (0<=elevation) & (elevation<=450) & (0<=slope) & (slope<=5))] = 15
-            speed_ar[np.where((rivers==1) & (0<=elevation) & (elevation<=450) & (5<slope) & (slope<=10))] = 7.5
-            speed_ar[np.where((rivers==1) & (0<=elevation) & (elevation<=450) & (10<slope) & (slope<=15))] = 3.8
-            speed_ar[np.where((rivers==1) & (0<=elevation) & (elevation<=450) & (15<slope) & (slope<=25))] = 1.9
-            speed_ar[np.where((rivers==1) & (0<=elevation) & (elevation<=450) & (25<slope) & (slope<=1000))] = 1.4
-            speed_ar[np.where((rivers==1) & (450<elevation) & (elevation<=700) & (0<=slope) & (slope<=5))] = 7.5
-            speed_ar[np.where((rivers==1) & (450<elevation) & (elevation<=700) & (5<slope) & (slope<=10))] = 3.9
-            speed_ar[np.where((rivers==1) & (450<elevation) & (elevation<=700) & (10<slope) & (slope<=15))] = 2.7
-            speed_ar[np.where((rivers==1) & (450<elevation) & (elevation<=700) & (15<slope) & (slope<=25))] = 1.9
-            speed_ar[np.where((rivers==1) & (450<elevation) & (elevation<=700) & (25<slope) & (slope<=1000))] = 1.4
-            speed_ar[np.where((rivers==1) & (700<elevation) & (elevation<=1800) & (0<=slope) & (slope<=5))] = 3.8
-            speed_ar[np.where((rivers==1) & (700<elevation) & (elevation<=1800) & (5<slope) & (slope<=10))] = 2.7
-            speed_ar[np.where((rivers==1) & (700<elevation) & (elevation<=1800) & (10<slope) & (slope<=15))] = 2.0
-            speed_ar[np.where((rivers==1) & (700<elevation) & (elevation<=1800) & (15<slope) & (slope<=25))] = 1.7
-            speed_ar[np.where((rivers==1) & (700<elevation) & (elevation<=1800) & (25<slope) & (slope<=1000))] = 1.4
-            speed_ar[np.where((rivers==1) & (1800<elevation) & (elevation<=2800) & (0<=slope) & (slope<=5))] = 1.9
-            speed_ar[np.where((rivers==1) & (1800<elevation) & (elevation<=2800) & (5<slope) & (slope<=10))] = 1.9
-            speed_ar[np.where((rivers==1) & (1800<elevation) & (elevation<=2800) & (10<slope) & (slope<=15))] = 1.7
-            speed_ar[np.where((rivers==1) & (1800<elevation) & (elevation<=2800) & (15<slope) & (slope<=25))] = 1.4
-            speed_ar[np.where((rivers==1) & (1800<elevation) & (elevation<=2800) & (25<slope) & (slope<=1000))] = 1.3
-            speed_ar[np.where((rivers==1) & (2800<elevation) & (elevation<=10000) & (0<=slope) & (slope<=5))] = 1.4
-            speed_ar[np.where((rivers==1) & (2800<elevation) & (elevation<=10000) & (5<slope) & (slope<=10))] = 1.4
-            speed_ar[np.where((rivers==1) & (2800<elevation) & (elevation<=10000) & (10<slope) & (slope<=15))] = 1.4
-            speed_ar[np.where((rivers==1) & (2800<elevation) & (elevation<=10000) & (15<slope) & (slope<=25))] = 1.3
-            speed_ar[np.where((rivers==1) & (2800<elevation) & (elevation<=10000) & (25<slope) & (slope<=1000))] = 1.2
-
-            RASTER(rivers_path).close()
-            RASTER(slope_path).close()
-            RASTER(elev_path).close()
-            rivers, elevation, slope = None, None, None
-
-            # print('coast t')
-            coast = RASTER(coast_path).get_array().astype(int)
-            speed_ar = np.where(coast == 1, 20, speed_ar)
-            RASTER(coast_path).close()
-            coast = None
-
-            if in_path_l3:
-                # print('roads3 t')
-                roads3 = RASTER(in_path_l3).get_array().astype(int)
-                speed_ar = np.where(roads3 == 1, 30, speed_ar)
-                RASTER(in_path_l3).close()
-                roads3 = None
-
-            if in_path_l2:
-                # print('roads2 t')
-                roads2 = RASTER(in_path_l2).get_array().astype(int)
-                speed_ar = np.where(roads2 == 1, 40, speed_ar)
-                RASTER(in_path_l2).close()
-                roads2 = None
-
-            if in_path_l1:
-                # print('roads1 t')
-                roads1 = RASTER(in_path_l1).get_array().astype(int)
-                speed_ar = np.where(roads1 == 1, 60, speed_ar)
-                RASTER(in_path_l1).close()
-                roads1 = None
-
-            # print('built t')
-            built = RASTER(built_path).get_array().astype(int)
-            speed_ar = np.where(built == 1, 0, speed_ar)
-            RASTER(built_path).close()
-            built = None
-
-            # If a value is negative (happens on edges with voids of data),
-            # change to 4 as average walking speed
-            # print('               Changing issues to average walking')
-            bads = speed_ar<0
-            speed_ar[bads] = ave_walking
-            bads = None
-            # Change speeds to time that takes to cross each pixel horizontally
-            # or vertically
-            print('               Changing speeds to times')
-            xdist = base_raster.resX #  m
-            ydist = base_raster.resY #  m
-            diredist = (xdist + ydist) / 2
-            # Change only if there is a value of speed
-            goods = ~np.logical_or(speed_ar == nd, speed_ar == 0)
-            # Converts
-            # Multiplying by 36 to calculate times in 10s
-            # (or speed are exagerated 10 times)
-            # allows to keep one extra digit with ushort type
-            speed_ar[goods] = np.divide(diredist*36, speed_ar[goods]).astype(int)
-
-            # speed_ar[goods] = np.multiply(speed_ar[goods], )
-            goods = None
-            del goods
-
-            # Save to raster
-            print('               Saving times array to raster')
-            copy_raster(times_path, RASTER(base_path), Float=True, array=speed_ar.astype(int))
-            compress(times_path)
-            speed_ar = None
+            create_times_raster(times_path, base_path, flooded_path,
+                                crops_path, elev_path, slope_path,
+                                rivers_path, coast_path, built_path,
+                                (in_path_l3, in_path_l2, in_path_l1))
 
         # Get a list of source built pixels to start propagating the distances
         sources_path = f'{main_folder}HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_sources_{year_txt}{purp}{res}m.gpkg'#.replace("\\","/").replace("//","/")
@@ -1434,145 +2797,174 @@ def create_proximity_raster_from_pixels(layer, year, settings, base_path,
         # Propagate travel as time from built areas
         # using speeds raster and a max daily distance
         print('               Starting', datetime.now().strftime("%H:%M:%S"))
-
-        try:
-        # if True:
-            compute_cost_path(times_path, sources_path, final_path)
-            compress(final_path)
-
-        except MemoryError:
-        # if True:
-
-            # Get list of polygon layers
-            print()
-            print('*****************************************')
-            print('MemoryError: splitting accessibility area')
-            polygons = []
-            split_folder = main_folder + settings.split_folder
-            polygons += [split_folder+each for each in os.listdir(split_folder)]# if each.endswith('.gpkq')]
-
-            rasters_to_merge = []
-            with rasterio.open(times_path) as input_raster:
-
-                for polygon_path in polygons:
-                    
-                    file_name_with_ext = os.path.basename(polygon_path)
-                    name = os.path.splitext(file_name_with_ext)[0]
-                    # name = polygon.split('.')[0][-2:]
-                    print(f'   Processing {name}')
-
-                    # Split times raster by previously created polygons
-                    time_part_path = times_path.replace('.tif', f'_{name}.tif')
-                    split_raster(input_raster, time_part_path, polygon_path, name)
-
-                    # Calculate least_path and save split raster
-                    out_path = final_path.replace('prepared', f'prepared_{name}')
-                    rasters_to_merge.append(out_path)
-                    compute_cost_path(time_part_path, sources_path, out_path, poly_mask=polygon_path)
-
-            # Merge rasters parts
-            merge_rasters(rasters_to_merge, final_path)
-            compress(final_path)
-            print('*****************************************')
-            print()
+        max_cost = getattr(HF_scores, scoring_template)[scoring_method]['max_dist']
+        compute_cost_path(times_path, sources_path, final_path,
+                          max_cost=max_cost, workers=workers)
 
     else:
         print(f'            {layer} already prepared')
 
 
-def combineRasters(pressure, year, layers, settings, base_path, purpose, res,
-                    scoring_template, results_folder, main_folder):
+def reduce_rasters(groups, total_path=None, nodata=-9999, base_mask=None):
     """
-    Takes all datasets of a pressure and combines them by maximum value.
+    Combines rasters of the same grid block by block: each group by maximum
+    value (datasets of a pressure) and, optionally, all groups by sum
+    (pressures of a HF map), in one pass over the inputs. NoData of inputs
+    is ignored and a pixel is NoData only if all its inputs are NoData.
+    Values are kept in float32 and only windows are held in memory.
 
     Parameters
     ----------
-    pressure : Name of the pressure.
-    year : year of HF map.
-    layers : [datasets to be combined, are they multitemporal or not?].
-    settings : general settings from GENERAL_SETTINGS class.
-    base_path : path to base raster.
-    purpose : Purpose of the Human footprint maps. Will match purpose_layers
-        in Class GENERAL_SETTINGS.
-    scoring_template : Name of the scoring template from HF_scores. E.g. 'GHF'.
-    results_folder : Folder in root for all results.
-    main_folder : Name of folder in root for all analysis.
+    groups : list of (in_paths, out_path). out_path is the maximum of
+    in_paths, or None to not write it.
+    total_path : path for the sum of all groups. The default is None.
+    nodata : NoData value of outputs. The default is -9999.
+    base_mask : bit-packed mask of the study area (BASE_GRID.mask), to
+    clip outputs. The default is None.
 
     Returns
     -------
     None.
 
     """
-    print()
-    print(f'      Combining {pressure} {year}')
 
-    num = 0
+    groups = [([RASTER(path) for path in in_paths], out_path)
+              for in_paths, out_path in groups]
+    first_raster = groups[0][0][0]
+
+    # Create outputs
+    outputs = []
+    for rasters, out_path in groups + [(None, total_path)]:
+        out_ds = None
+        if out_path:
+            out_ds = create_empty_raster(out_path, first_raster, 'Float32')
+            out_ds.GetRasterBand(1).SetNoDataValue(nodata)
+        outputs.append(out_ds)
+
+    def write(out_ds, array, window):
+        if out_ds:
+            array = np.where(np.isnan(array), np.float32(nodata), array)
+            out_ds.GetRasterBand(1).WriteArray(array, window[0], window[1])
+
+    # Reduce window by window, NoData as NaN
+    for window in block_windows(first_raster):
+
+        outside = None
+        if base_mask is not None:
+            outside = ~get_mask_window(base_mask, window)
+
+        total = None
+        for (rasters, out_path), out_ds in zip(groups, outputs):
+
+            combined = None
+            for raster in rasters:
+                array = raster.get_window(window).astype(np.float32)
+                if raster.nodata is not None:
+                    array[array == raster.nodata] = np.nan
+                combined = array if combined is None else np.fmax(combined, array)
+            if outside is not None:
+                combined[outside] = np.nan
+            write(out_ds, combined, window)
+
+            if total_path:
+                total = combined if total is None else np.where(
+                    np.isnan(total), combined, total + np.nan_to_num(combined))
+
+        write(outputs[-1], total, window)
+
+    # Close everything
+    for out_ds in outputs:
+        if out_ds:
+            out_ds.GetRasterBand(1).ComputeStatistics(0)
+    outputs = None
+    for rasters, out_path in groups:
+        for raster in rasters:
+            raster.close()
+
+
+def combined_artifact(pressure, year, layers, settings, base_path, purpose,
+                      res, scoring_template, main_folder):
+    """
+    Paths of a combined pressure and of the scored rasters it's made from,
+    and the key of its inputs. Parameters as in combineRasters.
+
+    Returns
+    -------
+    added_path, press_paths, key, inputs
+
+    """
+
     extent = settings.extent_Polygon
     extent_str = extent.split('/')[-1].split('.')[-2]
     added_path = f'{main_folder}/HF_maps/b05_Added_pressures/p_{pressure}_{extent_str}_{purpose}_{year}_{scoring_template}_{res}m.tif'
-    exists = os.path.isfile(added_path)
 
-    if not exists:
+    press_paths = []
+    for layer, multitemp in layers:
 
-        for layer in layers:
+        # Get scoring method
+        scoring_method = layers_settings[layer]['scoring']
 
-            multitemp = False
-            for source in multitemporal_layers:
-                if layer[0] in multitemporal_layers[source]['datasets']:
-                    multitemp = True
+        year_txt = f'{year}_' if multitemp else ''
+        purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
 
-            # Get scoring method
-            scoring_method = layers_settings[layer[0]]['scoring']
+        # Get path of scored layer and of copy in results folder
+        press_paths.append(f'{main_folder}/HF_maps/b04_Scored_pressures/{extent_str}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_scored.tif')
 
-            # If it's Navigable_Waterways, it's multitemporal anyway
-            if scoring_method in ('indirect_scores'): multitemp = True
+    # Reuse the combined pressure only if it was made from the same scores
+    inputs = {'scored': [artifact_input(press_path) for press_path in press_paths],
+              'grid': grid_fingerprint(base_path)}
 
-            year_txt = f'{year}_' if multitemp else ''
-            purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
+    return added_path, press_paths, artifact_key(inputs), inputs
 
-            # Get path of scored layer and of copy in results folder
-            press_path = f'{main_folder}/HF_maps/b04_Scored_pressures/{extent_str}_{layer[0]}_{purp}{year_txt}{scoring_template}_{res}m_scored.tif'
 
-            # Get pressure raster array masked by NoData value
-            press_raster = RASTER(press_path)
-            nodata = press_raster.nodata
-            press_raster.get_array()
-            press_array = np.ma.masked_equal(press_raster.array, nodata)
+def combineRasters(pressure, year, layers, settings, base_path, purpose, res,
+                    scoring_template, results_folder, main_folder):
+    """
+    Takes all datasets of a pressure and combines them by maximum value.
 
+    Parameters
+    ----------
+    pressure : Name of the pressure.
+    year : year of HF map.
+    layers : [datasets to be combined, are they multitemporal or not?], as
+    resolved by LAYER_CATALOGUE in HF_tasks.
+    settings : general settings from GENERAL_SETTINGS class.
+    base_path : path to base raster.
+    purpose : Purpose of the Human footprint maps. Will match purpose_layers
+        in Class GENERAL_SETTINGS.
+    scoring_template : Name of the scoring template from HF_scores. E.g. 'GHF'.
+    results_folder : Folder in root for all results.
+    main_folder : Name of folder in root for all analysis.
 
-            # Create and add pressures to final map
-            if num == 0:
-                datout = press_array
-                fn1 = press_path
-            else:
-                if datout.dtype != np.float64 and press_array.dtype in (np.float64, np.float32):
-                    datout = datout.astype(np.float64)
-                    fn1 = press_path
-                np.maximum(datout, press_array, out=datout)
- 
-            # Close pressure raster
-            press_raster.close()
-            press_array = None
+    Returns
+    -------
+    None.
 
-            # Add 1 to num
-            num += 1
+    """
+    print()
+    print(f'      Combining {pressure} {year}')
 
+    # Reuse the combined pressure only if it was made from the same scores
+    added_path, press_paths, key, inputs = combined_artifact(
+        pressure, year, layers, settings, base_path, purpose, res,
+        scoring_template, main_folder)
+    exists = is_cached(added_path, key)
 
-        # Add rasters if there's at list one layer
-        if num > 0:
+    if not exists:
 
-            press_raster = RASTER(fn1)
-            createRasterFromCopy(added_path, press_raster.ds, datout)
-            press_raster.close()
-            datout = None
+        remove_artifacts([added_path])
 
-            # Compress result and delete previous version
-            compress(added_path)
+        # Combine by maximum value if there's at least one layer
+        if press_paths:
+            reduce_rasters([(press_paths, added_path)],
+                           base_mask=get_base_grid(base_path).mask)
+            save_artifact_metadata(added_path, key, inputs)
 
     else:
         print(f'         {pressure} {year} was already combined')
 
 
+@instrumented
 def addRasters(year, settings, results_folder, purpose, scoring_template, res, main_folder):
     """
     Adds pressure maps to the final HF map for a given year.
@@ -1594,12 +2986,14 @@ def addRasters(year, settings, results_folder, purpose, scoring_template, res, m
 
     print('   Copying pressure rasters')
 
-    num = 0
     extent = settings.extent_Polygon
     extent_str = extent.split('/')[-1].split('.')[-2]
+    country = settings.country
+    added_path = f'{results_folder}/HF_{country}_{extent_str}_{purpose}_{year}_{scoring_template}_{res}m.tif'
 
     # results_folder = r'G:\Conservation Solution Lab\People\Jose\OneDrive - UNBC\LoL_Data\Peru_HH\HF_maps\b05_HF_maps\Pe_20230605_183825_SDG15_Peru_IGN//'
 
+    press_paths = []
     for pressure in settings.purpose_layers[purpose]['pressures']:
 
         # Continue if there are layers in pressures
@@ -1611,150 +3005,139 @@ def addRasters(year, settings, results_folder, purpose, scoring_template, res, m
             # Make a copy of the pressures in the results folder
             press_path_results = f'{results_folder}/p_{pressure}_{extent_str}_{purpose}_{year}_{scoring_template}_{res}m.tif'
             shutil.copy2(press_path, press_path_results)
+            press_paths.append(press_path)
+
+    # Create the raster of added pressures if at least one topic was processed
+    if press_paths:
+        print('   Adding pressures')
+        reduce_rasters([([press_path], None) for press_path in press_paths],
+                       total_path=added_path)
 
-            # Get pressure array annd add to HF
-            press_raster = RASTER(press_path)
+    return added_path
 
-            # Get pressure raster array masked by NoData value
-            nodata = press_raster.nodata
-            press_raster.get_array()
-            press_array = np.ma.masked_equal(press_raster.array, nodata)
 
-            # Create and add pressures to final map
-            if num != 0:
-                datout = datout + press_array
+def finalise_raster(tif_path, rivers_mask_path, tags, rows=1024):
+    """
+    Finalises a raster of the results folder, read once and written
+    twice: water (rivers mask) as NoData, floats rounded to 2 decimals and
+    metadata tags are written by blocks of rows to a scratch GeoTIFF, which
+    the COG driver (it only creates copies) copies to a Cloud Optimized
+    GeoTIFF with internal overviews that replaces the raster.
 
-            else:
-                datout = press_array
-                fn1 = press_path
+    Parameters
+    ----------
+    tif_path : path to raster, which is replaced.
+    rivers_mask_path : path to bit-packed rivers mask (create_packed_mask).
+    tags : dict of metadata tags.
+    rows : number of rows read and written at a time. The default is 1024.
 
-            # Close pressure raster
-            press_raster.close()
-            press_array = None
+    Returns
+    -------
+    finalised : True if the raster was finalised.
 
-            # Add 1 to num
-            num += 1
+    """
 
-    # Create the raster of added pressures if at least one topic was processed
-    if num > 0:
-        print('   Adding pressures')
-        country = settings.country
-        added_path = f'{results_folder}/HF_{country}_{extent_str}_{purpose}_{year}_{scoring_template}_{res}m.tif'
-        # added_path_uncomp = f'{results_folder}/HF_{country}_{year}_{scoring_template}_{res}m_uncomp.tif'
-        press_raster = RASTER(fn1)
-        copy_raster(added_path, press_raster, Float=True, array=datout)
-        press_raster.close()
-        datout = None
-
-        # Compress result and delete previous version
-        compress(added_path)
-        # os.remove(added_path_uncomp)
+    rivers_mask = np.load(rivers_mask_path, mmap_mode='r')
+    tmp_path = tif_path + '.finalising'
+
+    # Mask water, round and tag, by blocks of rows
+    with rasterio.open(tif_path) as src:
+        nodata = src.nodata
+        if nodata is None:
+            print(f'Failed to retrieve nodata value from raster: {tif_path}')
+            return False
+        DataType = src.dtypes[0]
+        profile = src.profile.copy()
+        profile.update(driver='GTiff',
+                       **creation_options(DataType, as_list=False))
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            dst.update_tags(**src.tags())
+            dst.update_tags(**tags)
+            for yoff in range(0, src.height, rows):
+                window = Window(0, yoff, src.width, min(rows, src.height - yoff))
+                array = src.read(window=window)
+                array[:, get_mask_window(rivers_mask, (0, yoff, src.width,
+                                                       window.height))] = nodata
+                if DataType == 'float32':
+                    array = np.round(array, decimals=2)
+                dst.write(array, window=window)
+
+    # COG with overviews 2, 4, 8 and 16
+    cog_path = tif_path + '.cog'
+    result = gdal.Translate(cog_path, tmp_path, format='COG',
+                            creationOptions=cog_options(DataType))
+    check_gdal_result(result, f'COG of {tif_path}', cog_path)
+    result = None
+    os.replace(cog_path, tif_path)
+    os.remove(tmp_path)
+
+    return True
+
+
+def preparing_folder(results_folder, settings, main_folder, res, workers=1):
+    """
+    Finalises all rasters of the results folder (see finalise_raster),
+    in parallel if workers > 1. All workers read the same memory-mapped
+    rivers mask.
 
-    return added_path
+    Parameters
+    ----------
+    results_folder : path to folder with the results.
+    settings : general settings from GENERAL_SETTINGS class.
+    main_folder : Name of folder in root for all analysis.
+    res : resolution of the rasters.
+    workers : number of processes to finalise rasters. The default is 1.
 
+    Returns
+    -------
+    None.
 
-def preparing_folder(results_folder, settings, main_folder, res):
+    """
 
     print()
     print("""Masking water as no data, rounding to 2 decimals, 
 adding metadata and creating pyramids""")
 
-    # Open the river raster
+    # Rivers mask
     country_txt= settings.country[:2]
     extent = settings.extent_Polygon
     extent_str = extent.split('/')[-1].split('.')[-2]
     rivers_path = f'{main_folder}HF_maps/b03_Prepared_pressures/{extent_str}_{country_txt}_indirect_rivers_{res}m_rasterized.tif'
-    river_raster = gdal.Open(rivers_path, gdal.GA_ReadOnly)
-    if river_raster is None:
+    if not os.path.isfile(rivers_path):
         print("Failed to open river raster.")
         return
-
-    river_array = river_raster.GetRasterBand(1).ReadAsArray()
-    goods = np.equal(river_array, 1)
-
-
-    # Loop through all TIF files in the folder
-    for file_name in os.listdir(results_folder):
-        if file_name.endswith(".tif"):
-            
-            print(f'   {file_name}')
-            tif_path = os.path.join(results_folder, file_name)
-
-            # Mask water
-            # Open the TIF raster
-            tif_raster = gdal.Open(tif_path, gdal.GA_Update)
-            if tif_raster is None:
-                print(f"Failed to open TIF raster: {tif_path}")
-                continue
-
-            # Get the nodata value of the river raster
-            nodata_value = tif_raster.GetRasterBand(1).GetNoDataValue()
-            if nodata_value is None:
-                print("Failed to retrieve nodata value from raster.")
-                river_raster = None
-                return
-
-            # Get the number of raster bands
-            num_bands = tif_raster.RasterCount
-
-            # Loop through all bands in the TIF raster
-            for band_index in range(1, num_bands + 1):
-                band = tif_raster.GetRasterBand(band_index)
-                # Read the band as a NumPy array
-                array = band.ReadAsArray()
-                # Modify the pixels based on the river raster
-                array[goods] = nodata_value
-                # Write the modified array back to the band
-                band.WriteArray(array)
-
-            tif_raster = None
-
-            # Round to 2 decimals
-            round_ = False
-            with rasterio.open(tif_path, 'r+') as dataset:
-                if dataset.dtypes[0] == 'float32':
-                    round_ = True
-                    # print(tif_path)
-                    data = dataset.read(1)
-
-                    # Round the array values to 2 decimal places
-                    rounded_data = np.round(data, decimals=2)
-
-                    # Create a new output file
-                    profile = dataset.profile.copy()
-                    profile.update(dtype=rasterio.float32)
-            if round_:
-                # Write the rounded data to the same file
-                with rasterio.open(tif_path, 'w', **profile) as dst:
-                    dst.write(rounded_data, 1)
-                    
-            # Add metadata
-            with rasterio.open(tif_path, 'r+') as src:
-                
-                # Update the metadata tags
-                src.update_tags(
-                    Project="Maintaining Life on Land (SDG15) under Scenarios of Land Use and Climate Change in Colombia, Ecuador, and Peru",
-                    Funding="NASA Biodiversity and Ecological Forecasting Program",
-                    Institution="University of Northern British Columbia",
-                    Title="Human Footprint series for SDG15",
-                    License="CC-BY 4.0 license",
-                    Cite='Before article publication please use: Jose Aragon-Osejo et al. (2024) Human Footprint maps for SDG15 indicators',
-                    Date=datetime.today().strftime('%Y-%m-%d'),
-                    Version='Preprint',
-                    Author="Jose Aragon-Osejo",
-                    Contact='aragon@unbc.ca / jose.luis.aragon.ec@gmail.com'
-                )
-                
-            # Create pyramids
-            with rasterio.open(tif_path, 'r+') as dataset:
-                # if dataset.dtypes[0] == 'float32':
-                #     resampling_method = rasterio.enums.Resampling.nearest
-                # else:
-                #     resampling_method = rasterio.enums.Resampling.nearest
-
-                # dataset.build_overviews([2, 4, 8, 16], resampling=resampling_method)
-                dataset.build_overviews([2, 4, 8, 16], resampling=rasterio.enums.Resampling.nearest)
-
-
-    river_raster = None
-
+    rivers_mask_path = create_packed_mask(
+        rivers_path, rivers_path.replace('.tif', '_mask.npy'), value=1)
+
+    tags = dict(
+        Project="Maintaining Life on Land (SDG15) under Scenarios of Land Use and Climate Change in Colombia, Ecuador, and Peru",
+        Funding="NASA Biodiversity and Ecological Forecasting Program",
+        Institution="University of Northern British Columbia",
+        Title="Human Footprint series for SDG15",
+        License="CC-BY 4.0 license",
+        Cite='Before article publication please use: Jose Aragon-Osejo et al. (2024) Human Footprint maps for SDG15 indicators',
+        Date=datetime.today().strftime('%Y-%m-%d'),
+        Version='Preprint',
+        Author="Jose Aragon-Osejo",
+        Contact='aragon@unbc.ca / jose.luis.aragon.ec@gmail.com'
+        )
+
+    # All TIF files in the folder
+    tif_paths = [os.path.join(results_folder, file_name)
+                 for file_name in sorted(os.listdir(results_folder))
+                 if file_name.endswith(".tif")]
+
+    # Finalise rasters
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    if executor:
+        results = executor.map(finalise_raster, tif_paths,
+                               [rivers_mask_path] * len(tif_paths),
+                               [tags] * len(tif_paths))
+    else:
+        results = (finalise_raster(tif_path, rivers_mask_path, tags)
+                   for tif_path in tif_paths)
+    for tif_path, finalised in zip(tif_paths, results):
+        if finalised:
+            print(f'   {os.path.basename(tif_path)}')
+    if executor:
+        executor.shutdown()
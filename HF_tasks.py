@@ -27,11 +27,15 @@ Created on Thu Jun 18 18:26:00 2020
 """
 
 import os
-import shutil
+import json
+import csv
+from bisect import bisect_left
 from HF_settings import GENERAL_SETTINGS
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from shutil import copyfile
 import numpy as np
+import HF_scores
 from HF_layers import multitemporal_layers, layers_settings
 from HF_spatial import *  # TODO change
 from HF_validation import validate_HF_map
@@ -42,7 +46,8 @@ class begin_HF():
 
     """
 
-    def __init__(self, purpose, tasks, country_processing):
+    def __init__(self, purpose, tasks, country_processing, workers=1,
+                 plan_only=False, profile=False):
         """
 
         Parameters
@@ -52,6 +57,12 @@ class begin_HF():
         tasks : Tasks to perform: preparing, scoring, combining and calculating
         the maps, validating.
         main_folder : Name of folder in root for all analysis.
+        workers : Number of processes running tasks at the same time.
+        plan_only : True to print the plan of tasks (artifacts to build or
+        reuse, time and memory estimates) without running them nor creating
+        folders or the base raster.
+        profile : True to save cProfile stats of each task in the folder
+        'profiles' of the results folder.
 
         Returns
         -------
@@ -63,7 +74,7 @@ class begin_HF():
         # General settings
         self.main_folder = os.getcwd() + f'/{country_processing}//'
         settings = GENERAL_SETTINGS(country_processing, self.main_folder)
-        scoring_template = settings.scoring_template
+        _settings_cache[country_processing] = settings
         purpose_layers = settings.purpose_layers[purpose]
         years = purpose_layers['years']
         res = purpose_layers['pixel_res']
@@ -73,115 +84,440 @@ class begin_HF():
         print('------------------------------------------------------------------------------------------------------------------------------')
 
         # Prepare working folders
-        self.prepare_working_folders()
+        if not plan_only:
+            self.prepare_working_folders()
 
         # Prepare base raster layer
-        base_path = self.prepare_base_raster(settings, res)
+        base_path = self.prepare_base_raster(settings, res, plan_only)
 
         # Prepare results folder
         extent = settings.extent_Polygon.split('/')[-1].split('.')[-2]
-        results_folder = self.create_processing_folder(settings, purpose, extent, res)
+        results_folder = self.create_processing_folder(settings, purpose,
+                                                       extent, res, plan_only)
 
         if tasks and purpose_layers['pressures']:
 
-            # Prepare and score pressures and loop by topics first topic
-            for pressure in purpose_layers['pressures']:
-
-                if purpose_layers['pressures'][pressure]['datasets'] and years:
-                    print()
-                    print(f'Processing {pressure}')
-
-                list_datasets = {}
-                for year in years:
-
-                    for dataset in purpose_layers['pressures'][pressure]['datasets']:
-
-                        if year not in list_datasets:
-                            list_datasets[year] = []
-
-                        # Determine year to use and scoring method
-                        if dataset in multitemporal_layers:
-
-                            # Determine which version in time is closer to year,
-                            # if it's a multitemporal layer
-                            closer_year = 1000000
-                            for layer_aux in multitemporal_layers[dataset]['datasets']:
-                                version_year = layers_settings[layer_aux]['year']
-                                if abs(version_year - year) <= abs(closer_year - year):
-                                    closer_year = version_year
-                                    layer = layer_aux
-
-                            # Determine scoring methods
-                            # If it's a multitemporal layer, use first one for scoring
-                            layer_aux = multitemporal_layers[dataset]['datasets'][0]
-                            scoring_method = layers_settings[layer_aux]['scoring']
-                            multitemp = True
-
-                        else:
-                            layer = dataset
-                            scoring_method = layers_settings[layer]['scoring']
-                            multitemp = False
-
-
-                        # If it's Navigable_Waterways, it's multitemporal anyway
-                        # if pressure == 'Navigable_Waterways': multitemp = True
-                        if scoring_method in ('indirect_scores'): multitemp = True
-
-                        list_datasets[year].append([layer,multitemp])
-
-
-                        if "Preparing" in tasks:
-                            PREPARING(layer, year, settings, base_path, purpose,
-                                      scoring_template, scoring_method,
-                                      results_folder, self.main_folder, res,
-                                      multitemp)
-
-                        if "Scoring" in tasks:
-                            SCORING(layer, year, settings, base_path, purpose,
-                                    scoring_template, scoring_method,
-                                    self.main_folder, multitemp, res)
-
-                for year in years:
-                    if "Combining" in tasks and list_datasets:
-                        combineRasters(pressure, year, list_datasets[year],
-                                        settings, base_path, purpose, res,
-                                        scoring_template, results_folder,
-                                        self.main_folder)
-
-            # Calculate maps
-            if "Calculating_maps" in tasks:
-                for year in years:
-                    last_y = True if year == years[-1] else False
-                    CALCULATING_MAPS(year, settings, results_folder, purpose,
-                                      scoring_template, res, last_y,
-                                      self.main_folder,)
-
-            # Mask water
-            if "Preparing_folder" in tasks:
-                # tif_folder = r"G:\Conservation Solution Lab\People\Jose\OneDrive - UNBC\LoL_Data\Peru_HH\HF_maps\b05_HF_maps\Pe_20230605_183825_SDG15_Peru_IGN"
-                # river_raster_path = r"Z:\Peru_HH\HF_maps\b03_Prepared_pressures/Peru_IGN_Pe_luc_Mapbiopmas_15_2015_GHF_30m_prepared.tif"
-                # water_val = 33
-                preparing_folder(results_folder, settings, self.main_folder,
-                                  res)
-
-            # Mask water
-            if "Validating" in tasks:
-                # tif_folder = r"G:\Conservation Solution Lab\People\Jose\OneDrive - UNBC\LoL_Data\Peru_HH\HF_maps\b05_HF_maps\Pe_20230605_183825_SDG15_Peru_IGN"
-                # river_raster_path = r"Z:\Peru_HH\HF_maps\b03_Prepared_pressures/Peru_IGN_Pe_luc_Mapbiopmas_15_2015_GHF_30m_prepared.tif"
-                # water_val = 33
-                if 2018 in years and not settings.clip_by_Polygon:
-                    validate_HF_map(self.main_folder, settings, purpose, 
-                                    results_folder, res, settings.country)
-                else:
-                    print('''
+            # Build the graph of tasks, plan it and run it
+            tasks_graph = self.build_tasks_graph(tasks, settings, purpose,
+                                                 base_path, results_folder,
+                                                 res, workers)
+            self.plan = self.plan_tasks_graph(tasks_graph, settings,
+                                              base_path, res, workers)
+            if plan_only:
+                self.print_plan(self.plan, workers)
+                return
+            profile_folder = f'{results_folder}/profiles' if profile else None
+            self.run_tasks_graph(tasks_graph, country_processing, workers,
+                                 profile_folder)
+            self.save_history(self.plan)
+            write_run_report(self.records, results_folder, self.pixels)
+
+
+    def build_tasks_graph(self, tasks, settings, purpose, base_path,
+                          results_folder, res, workers=1):
+        """
+        Builds the graph of tasks of a purpose. Each node is a task on one
+        layer, pressure or year and depends on the nodes it reads from:
+            - Scoring a layer depends on preparing it.
+            - Combining a pressure depends on scoring all its layers.
+            - Preparing indirect pressures depends on the combined Land_Cover
+            and Built_Environments of the year and on preparing Roads_Railways.
+            - Preparing the same dataset for several years is chained, as
+            their intermediate files (clipped vectors, rasterized, flooded...)
+            are shared and versions of multitemporal rasters are warped
+            together by the first one.
+            - Calculating maps depends on combining all pressures of the year,
+            preparing the folder on all maps and validating on the folder.
+
+        Parameters
+        ----------
+        tasks : Tasks to perform.
+        settings : general settings from GENERAL_SETTINGS class.
+        purpose : Purpose of the Human footprint maps.
+        base_path : path to base raster.
+        results_folder : Folder in root for all results.
+        res : pixel resolution.
+        workers : number of processes running nodes at the same time. The
+        cores left are used by each node to compute tiles in parallel.
+
+        Returns
+        -------
+        tasks_graph : dict of nodes {key: {'task', 'kwargs', 'deps'}} in
+        the order of the original sequential workflow.
+
+        """
+
+        scoring_template = settings.scoring_template
+        purpose_layers = settings.purpose_layers[purpose]
+        years = purpose_layers['years']
+        tasks_graph = {}
+        last_prepared = {}
+        tile_workers = max(1, (os.cpu_count() or 1) // max(1, workers))
+        resolved = get_catalogue().resolve(purpose_layers)
+
+        def add_node(key, task, kwargs, deps=()):
+            deps = {dep for dep in deps if dep and dep != key}
+            if key in tasks_graph:
+                tasks_graph[key]['deps'] |= deps
+            else:
+                tasks_graph[key] = {'task': task, 'kwargs': kwargs,
+                                    'deps': deps}
+
+        # Prepare and score pressures, then combine them by year
+        for pressure in purpose_layers['pressures']:
+
+            for year in years:
+
+                # Version closer in time to year of multitemporal layers
+                # and scoring methods, from the catalogue of layers
+                list_datasets = []
+                for dataset, layer, multitemp, scoring_method in \
+                        resolved[(pressure, year)]:
+
+                    list_datasets.append([layer, multitemp])
+
+                    # Layers that are not multitemporal are done once
+                    year_key = year if multitemp else None
+                    prepare_key = ('Preparing', layer, year_key)
+                    score_key = ('Scoring', layer, year_key)
+
+                    if "Preparing" in tasks:
+                        deps = [last_prepared.get(dataset)]
+                        if scoring_method in ('indirect_scores'):
+                            deps += [('Combining', 'Land_Cover', year),
+                                     ('Combining', 'Built_Environments', year)]
+                            deps += [('Preparing', 'Roads_Railways')]
+                        if prepare_key not in tasks_graph:
+                            last_prepared[dataset] = prepare_key
+                        add_node(prepare_key, PREPARING,
+                                 dict(layer=layer, year=year,
+                                      base_path=base_path, purpose=purpose,
+                                      scoring_template=scoring_template,
+                                      scoring_method=scoring_method,
+                                      results_folder=results_folder,
+                                      main_folder=self.main_folder, res=res,
+                                      multitemp=multitemp,
+                                      workers=tile_workers),
+                                 deps)
+                        tasks_graph[prepare_key]['pressure'] = pressure
+
+                    if "Scoring" in tasks:
+                        add_node(score_key, SCORING,
+                                 dict(layer=layer, year=year,
+                                      base_path=base_path, purpose=purpose,
+                                      scoring_template=scoring_template,
+                                      scoring_method=scoring_method,
+                                      main_folder=self.main_folder,
+                                      multitemp=multitemp, res=res),
+                                 [prepare_key])
+                        tasks_graph[score_key]['pressure'] = pressure
+
+                if "Combining" in tasks and list_datasets:
+                    deps = [(task, layer, year if multitemp else None)
+                            for task in ('Preparing', 'Scoring')
+                            for layer, multitemp in list_datasets]
+                    add_node(('Combining', pressure, year), combineRasters,
+                             dict(pressure=pressure, year=year,
+                                  layers=list_datasets, base_path=base_path,
+                                  purpose=purpose, res=res,
+                                  scoring_template=scoring_template,
+                                  results_folder=results_folder,
+                                  main_folder=self.main_folder),
+                             deps)
+
+        # Calculate maps
+        if "Calculating_maps" in tasks:
+            for year in years:
+                last_y = True if year == years[-1] else False
+                deps = [key for key in tasks_graph
+                        if key[0] == 'Combining' and key[2] == year]
+                add_node(('Calculating_maps', year), CALCULATING_MAPS,
+                         dict(year=year, results_folder=results_folder,
+                              purpose=purpose,
+                              scoring_template=scoring_template, res=res,
+                              last_y=last_y, main_folder=self.main_folder),
+                         deps)
+
+        # Mask water
+        if "Preparing_folder" in tasks:
+            add_node(('Preparing_folder',), preparing_folder,
+                     dict(results_folder=results_folder,
+                          main_folder=self.main_folder, res=res,
+                          workers=tile_workers),
+                     list(tasks_graph))
+
+        # Validate
+        if "Validating" in tasks:
+            if 2018 in years and not settings.clip_by_Polygon:
+                add_node(('Validating',), validate_HF_map,
+                         dict(main_folder=self.main_folder, purpose=purpose,
+                              results_folder=results_folder, res=res,
+                              country=settings.country),
+                         list(tasks_graph))
+            else:
+                print('''
 ********************************************************
 Validation can only be performed when the HF is created
 at the national level AND for the year 2018.
 ********************************************************
                           ''')
 
+        # Expand dependencies on whole pressures and drop the ones on tasks
+        # that are not performed
+        for node in tasks_graph.values():
+            for task, pressure in [dep for dep in node['deps'] if len(dep) == 2
+                                   and dep[0] == 'Preparing']:
+                node['deps'].remove((task, pressure))
+                node['deps'] |= {key for key, aux in tasks_graph.items()
+                                 if key[0] == task
+                                 and aux.get('pressure') == pressure}
+            node['deps'] &= set(tasks_graph)
+
+        return tasks_graph
+
+
+    def run_tasks_graph(self, tasks_graph, country_processing, workers=1,
+                        profile_folder=None):
+        """
+        Runs the graph of tasks, submitting every node whose dependencies are
+        done. With one worker, nodes run in this process in the order of the
+        original workflow; otherwise they run in a pool of processes, each
+        one loading its own general settings.
+
+        Parameters
+        ----------
+        tasks_graph : graph of tasks from build_tasks_graph.
+        country_processing : Name of folder in root for all analysis.
+        workers : number of processes running nodes at the same time.
+        profile_folder : folder to save cProfile stats of each node, None
+        to not profile them. The default is None.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self.timings = {}
+        self.records = []
+        done = set()
+        pending = dict(tasks_graph)
+
+        def ready_nodes():
+            return [key for key, node in pending.items()
+                    if node['deps'] <= done]
+
+        def log_done(key, result):
+            elapsed, records = result
+            self.timings[key] = elapsed
+            self.records += records
+            done.add(key)
+            print(f"      Done {' '.join(str(k) for k in key if k is not None)}"
+                  f" in {timedelta(seconds=elapsed)}")
+
+        if workers <= 1:
+            while pending:
+                key = ready_nodes()[0]
+                node = pending.pop(key)
+                log_done(key, run_task(node['task'], node['kwargs'],
+                                       country_processing, self.main_folder,
+                                       key, profile_folder))
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while pending or running:
+                for key in ready_nodes():
+                    node = pending.pop(key)
+                    future = executor.submit(run_task, node['task'],
+                                             node['kwargs'],
+                                             country_processing,
+                                             self.main_folder, key,
+                                             profile_folder)
+                    running[future] = key
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    log_done(running.pop(future), future.result())
+
+
+    def plan_tasks_graph(self, tasks_graph, settings, base_path, res,
+                         workers=1):
+        """
+        Plans the graph of tasks without running it: the artifact of each
+        node, if it will be built or reused, and estimates of its runtime
+        (from the history of previous runs, per megapixel) and peak memory
+        (from task_memory). Nodes whose memory times the number of workers
+        is over 80% of the memory of this machine are flagged.
+
+        Parameters
+        ----------
+        tasks_graph : graph of tasks from build_tasks_graph.
+        settings : general settings from GENERAL_SETTINGS class.
+        base_path : path to base raster.
+        res : pixel resolution.
+        workers : number of processes running nodes at the same time.
+
+        Returns
+        -------
+        plan : dict {key: {'kind', 'artifact', 'build', 'seconds',
+        'memory', 'memory_risk'}} in the order of tasks_graph.
+
+        """
+
+        XSize, YSize = self.grid_shape(settings, base_path, res)
+        self.pixels = XSize * YSize
+        history = self.load_history()
+        ram = total_memory()
+        base_exists = os.path.isfile(base_path)
+        held_pixels = {'window': XSize * 256,
+                       'tile': (1024 + 2 * 128) ** 2,
+                       'raster': self.pixels}
+
+        # Nodes are planned after their dependencies, as a new dependency
+        # means a new artifact
+        steps = {}
+        pending = dict(tasks_graph)
+        while pending:
+            key = [key for key, node in pending.items()
+                   if node['deps'] <= set(steps)][0]
+            node = pending.pop(key)
+            kwargs = node['kwargs']
+            kind = task_kind(key, node)
+            deps_built = any(steps[dep]['build'] for dep in node['deps'])
+            build = True
+
+            if key[0] == 'Preparing':
+                artifact = prepared_artifact(
+                    kwargs['layer'], kwargs['year'], settings, base_path,
+                    kwargs['purpose'], kwargs['scoring_template'],
+                    kwargs['scoring_method'], kwargs['main_folder'],
+                    kwargs['res'], kwargs['multitemp']) if base_exists else None
+                if artifact:
+                    build = not is_cached(artifact[0], artifact[1])
+                    if kwargs['scoring_method'] in ('indirect_scores'):
+                        build = build or deps_built
+
+            elif key[0] == 'Scoring':
+                artifact = scored_artifact(
+                    kwargs['layer'], kwargs['year'], settings, base_path,
+                    kwargs['purpose'], kwargs['scoring_template'],
+                    kwargs['scoring_method'], kwargs['main_folder'],
+                    kwargs['multitemp'], kwargs['res']) if base_exists else None
+                if artifact:
+                    artifact = artifact[1:]
+                    build = deps_built or not is_cached(artifact[0], artifact[1])
+
+            elif key[0] == 'Combining':
+                artifact = combined_artifact(
+                    kwargs['pressure'], kwargs['year'], kwargs['layers'],
+                    settings, base_path, kwargs['purpose'], kwargs['res'],
+                    kwargs['scoring_template'],
+                    kwargs['main_folder']) if base_exists else None
+                if artifact:
+                    artifact = (artifact[0], artifact[2])
+                    build = deps_built or not is_cached(artifact[0], artifact[1])
+
+            else:
+                # Maps, folder and validation are made in a new results folder
+                artifact = (kwargs['results_folder'], None)
+
+            seconds = None
+            if not build:
+                seconds = 0
+            elif history.get(kind):
+                seconds = float(np.median(history[kind])) * self.pixels / 1e6
+
+            held, bytes_pixel = task_memory.get(kind, task_memory.get(key[0]))
+            memory = held_pixels[held] * bytes_pixel
+            memory_risk = bool(build and ram and
+                               memory * max(1, workers) > 0.8 * ram)
+
+            steps[key] = {'kind': kind,
+                          'artifact': artifact[0] if artifact else None,
+                          'build': build, 'seconds': seconds,
+                          'memory': memory, 'memory_risk': memory_risk}
+
+        return {key: steps[key] for key in tasks_graph}
+
+    def print_plan(self, plan, workers=1):
+        """ Prints the plan from plan_tasks_graph and its totals """
+
+        print()
+        print(f'Plan for {self.pixels / 1e6:.1f} megapixels per raster')
+        for key, step in plan.items():
+            name = ' '.join(str(k) for k in key if k is not None)
+            seconds = step['seconds']
+            time_txt = '?' if seconds is None else str(timedelta(seconds=round(seconds)))
+            print(f"   {'build' if step['build'] else 'reuse'}  {name}"
+                  f"  {time_txt}  {step['memory'] / 2**20:.0f} MB"
+                  f"{'  MEMORY RISK' if step['memory_risk'] else ''}")
+            if step['artifact']:
+                print(f"          {os.path.basename(os.path.normpath(step['artifact']))}")
+
+        built = [step for step in plan.values() if step['build']]
+        known = [step['seconds'] for step in built if step['seconds'] is not None]
+        print()
+        print(f'   {len(built)} to build, {len(plan) - len(built)} to reuse, '
+              f"{sum(step['memory_risk'] for step in plan.values())} "
+              'with memory risk')
+        estimate = (f'   Estimated time: {timedelta(seconds=round(sum(known)))} '
+                    'in one process, '
+                    f'{timedelta(seconds=round(sum(known) / max(1, workers)))} '
+                    f'with {workers} workers')
+        if len(known) < len(built):
+            estimate += f' (without {len(built) - len(known)} tasks with no history)'
+        print(estimate)
+
+    def grid_shape(self, settings, base_path, res):
+        """
+        Columns and rows of the base raster, from the extent polygon if the
+        base raster doesn't exist yet. Nothing is saved next to the base
+        raster, so planning writes no files.
+
+        """
 
-    def create_processing_folder(self, settings, purpose, extent, res):
+        if os.path.isfile(base_path):
+            base_grid = get_base_grid(base_path, persist=False)
+            return base_grid.XSize, base_grid.YSize
+
+        extent_polygon = VECTOR(settings.extent_Polygon)
+        w, e, s, n = extent_polygon.extent
+        extent_polygon.close()
+
+        return int((e - w) / res + 0.5), int((n - s) / res + 0.5)
+
+    def history_path(self):
+        """ Path of the history of runtimes of previous runs """
+        return f'{self.main_folder}HF_maps/run_history.json'
+
+    def load_history(self):
+        """ History of runtimes: {kind of task: [seconds per megapixel]} """
+        if os.path.isfile(self.history_path()):
+            with open(self.history_path()) as f:
+                return json.load(f)
+        return {}
+
+    def save_history(self, plan):
+        """
+        Adds the runtimes of the tasks that were built in the last run to
+        the history, keeping the last 20 of each kind of task.
+
+        """
+
+        history = self.load_history()
+        for key, elapsed in self.timings.items():
+            step = plan.get(key)
+            if step and step['build']:
+                runtimes = history.setdefault(step['kind'], [])
+                runtimes.append(elapsed / self.pixels * 1e6)
+                history[step['kind']] = runtimes[-20:]
+
+        with open(self.history_path(), 'w') as f:
+            json.dump(history, f, indent=1)
+
+    def create_processing_folder(self, settings, purpose, extent, res,
+                                 plan_only=False):
         """
         Creates a new folder for all results.
 
@@ -190,6 +526,7 @@ at the national level AND for the year 2018.
         settings : general settings from GENERAL_SETTINGS class.
         purpose : Purpose of the Human footprint maps. Will match purpose_layers
         in Class GENERAL_SETTINGS.
+        plan_only : True to only return the path. The default is False.
 
         Returns
         -------
@@ -203,6 +540,8 @@ at the national level AND for the year 2018.
         now = datetime.now()
         dt_string = now.strftime("_%Y%m%d_%H%M%S")
         folder_path = f'{self.main_folder}/HF_maps/b06_HF_maps/{country[:2]}{dt_string}_{purpose}_{extent}_{res}m'
+        if plan_only:
+            return folder_path
         os.mkdir(folder_path)
 
         scripts = ('layers', 'main', 'scores', 'settings', 'spatial', 'tasks',
@@ -249,7 +588,7 @@ at the national level AND for the year 2018.
             if not os.path.exists(f):
                 os.makedirs(f)
 
-    def prepare_base_raster(self, settings, res):
+    def prepare_base_raster(self, settings, res, plan_only=False):
         """
         Converts extent polygon to a raster if necessary.
         The base raster will be the model for ALL rasters to be created.
@@ -257,6 +596,7 @@ at the national level AND for the year 2018.
         Parameters
         ----------
         settings : general settings from GENERAL_SETTINGS class.
+        plan_only : True to only return the path. The default is False.
 
         Returns
         -------
@@ -269,6 +609,8 @@ at the national level AND for the year 2018.
         # res = settings.pixel_res
         chunk = extent.split('/')[-1].replace('.', '_')
         base_path = f'{self.main_folder}HF_maps/b02_Base_rasters/base_{chunk}_{res}m.tif'
+        if plan_only:
+            return base_path
 
         # Search for base raster is exists
         base = os.path.isfile(base_path)
@@ -279,16 +621,270 @@ at the national level AND for the year 2018.
             print('Creating base raster')
             create_base_raster(base_path, settings, res)
 
-            # Compress result and delete previous version
-            compress(base_path)
-
         else:
             print()
             print('Base raster already existed')
 
+        # Grid and mask of the study area, shared by all stages, saved
+        # before workers read them
+        get_base_grid(base_path).mask
+
         return base_path
 
 
+_settings_cache = {}
+
+# Approximate peak memory of each kind of task for plan_tasks_graph: what
+# it holds at once (a window of rows, a tile of compute_cost_path with its
+# halo or whole rasters) and bytes per pixel of it
+task_memory = {
+    'Preparing': ('window', 64),
+    'Preparing indirect_scores': ('tile', 400),
+    'Scoring': ('window', 48),
+    'Combining': ('window', 48),
+    'Calculating_maps': ('window', 48),
+    'Preparing_folder': ('raster', 14),
+    'Validating': ('window', 48),
+    }
+
+
+class LAYER_CATALOGUE():
+    """
+    Catalogue of layers for planning: versions of each multitemporal dataset
+    sorted by year, the dataset of each version and scoring methods.
+    It is built from HF_layers in memory, once per process (see
+    get_catalogue), as building it is cheap.
+    """
+
+    def __init__(self):
+        catalogue = self.build()
+        self.datasets = catalogue['datasets']
+        self.sources = catalogue['sources']
+        self.scoring = catalogue['scoring']
+
+    @staticmethod
+    def build():
+        """
+        Builds the catalogue from HF_layers. Versions of the same year are
+        reduced to the last one, as the linear search did.
+
+        Returns
+        -------
+        catalogue : dict of datasets, sources and scoring methods.
+
+        """
+
+        datasets, sources = {}, {}
+        for dataset, values in multitemporal_layers.items():
+            versions = {}
+            for layer in values['datasets']:
+                versions[layers_settings[layer]['year']] = layer
+                sources[layer] = dataset
+            years = sorted(versions)
+            # Scoring method of the first version is used for all of them
+            datasets[dataset] = {
+                'years': years,
+                'layers': [versions[year] for year in years],
+                'scoring': layers_settings[values['datasets'][0]]['scoring']}
+
+        scoring = {layer: values.get('scoring')
+                   for layer, values in layers_settings.items()}
+
+        return {'datasets': datasets, 'sources': sources, 'scoring': scoring}
+
+    def closest_version(self, dataset, year):
+        """
+        Version of a multitemporal dataset closest in time to year. If two
+        versions are equally close, the later one.
+
+        """
+
+        years = self.datasets[dataset]['years']
+        i = bisect_left(years, year)
+        if i == len(years) or (i > 0 and year - years[i - 1] < years[i] - year):
+            i -= 1
+
+        return self.datasets[dataset]['layers'][i]
+
+    def source(self, layer):
+        """ Multitemporal dataset of a layer, None if it isn't a version """
+        return self.sources.get(layer)
+
+    def resolve(self, purpose_layers):
+        """
+        Resolves the layers of all pressures and years of a purpose.
+
+        Parameters
+        ----------
+        purpose_layers : settings of the purpose from purpose_layers in
+        GENERAL_SETTINGS.
+
+        Returns
+        -------
+        resolved : dict {(pressure, year): [(dataset, layer, multitemp,
+        scoring_method), ...]} in the order of the settings.
+
+        """
+
+        resolved = {}
+        for pressure, values in purpose_layers['pressures'].items():
+            for year in purpose_layers['years']:
+                resolved[(pressure, year)] = []
+                for dataset in values['datasets']:
+
+                    # Closest version in time to year if it's multitemporal
+                    if dataset in self.datasets:
+                        layer = self.closest_version(dataset, year)
+                        scoring_method = self.datasets[dataset]['scoring']
+                        multitemp = True
+                    else:
+                        layer = dataset
+                        scoring_method = self.scoring[layer]
+                        multitemp = False
+
+                    # Indirect pressures are made for every year anyway
+                    if scoring_method in ('indirect_scores'): multitemp = True
+
+                    resolved[(pressure, year)].append(
+                        (dataset, layer, multitemp, scoring_method))
+
+        return resolved
+
+
+_catalogue = None
+
+
+def get_catalogue():
+    """ Returns the LAYER_CATALOGUE, loaded once per process """
+    global _catalogue
+    if _catalogue is None:
+        _catalogue = LAYER_CATALOGUE()
+    return _catalogue
+
+
+def scored_artifact(layer, year, settings, base_path, purpose,
+                    scoring_template, scoring_method, main_folder, multitemp,
+                    res):
+    """
+    Paths of a scored pressure and of the prepared pressure it's made from,
+    and the key of its inputs. Parameters as in SCORING.
+
+    Returns
+    -------
+    in_path, scored_path, key, inputs
+
+    """
+
+    extent = settings.extent_Polygon
+    extent_str = extent.split('/')[-1].split('.')[-2]
+    year_txt = f'{year}_' if multitemp else ''
+    purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
+    in_path = f'{main_folder}/HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_prepared.tif'
+    scored_path = f'{main_folder}/HF_maps/b04_Scored_pressures/{extent_str}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_scored.tif'
+    scoring_method = layers_settings[layer]['scoring']
+
+    inputs = {'prepared': artifact_input(in_path),
+              'layer': layers_settings[layer],
+              'scores': getattr(HF_scores, scoring_template).get(scoring_method),
+              'grid': grid_fingerprint(base_path)}
+
+    return in_path, scored_path, artifact_key(inputs), inputs
+
+
+def task_kind(key, node):
+    """ Kind of task of a node for estimates, e.g. 'Preparing warp_scores' """
+    if key[0] == 'Preparing':
+        return f"Preparing {node['kwargs']['scoring_method']}"
+    return key[0]
+
+
+def total_memory():
+    """ Physical memory of this machine in bytes, None if unknown """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def run_task(task, kwargs, country_processing, main_folder, key,
+             profile_folder=None):
+    """
+    Runs one node of the graph of tasks, in this process or in a worker
+    of the pool. General settings are loaded once per process, as they
+    can't be sent between processes.
+    The task and the stages nested in it are measured with instrument.
+
+    Parameters
+    ----------
+    key : key of the node in the graph, to label its measures.
+    profile_folder : folder to save cProfile stats of the task, None to
+    not profile it. The default is None.
+
+    Returns
+    -------
+    elapsed : seconds taken by the task.
+    records : measures of the task and its nested stages.
+
+    """
+
+    if country_processing not in _settings_cache:
+        _settings_cache[country_processing] = GENERAL_SETTINGS(
+            country_processing, main_folder)
+    settings = _settings_cache[country_processing]
+
+    name = '_'.join(str(k) for k in key if k is not None)
+    profile_path = f'{profile_folder}/{name}.prof' if profile_folder else None
+    layer = key[1] if len(key) == 3 else None
+    year = key[-1] if len(key) > 1 and not isinstance(key[-1], str) else None
+
+    del stage_records[:]
+    with instrument(task.__name__, profile_path=profile_path,
+                    layer=layer, year=year) as record:
+        task(settings=settings, **kwargs)
+
+    # Nested stages have the layer and year of the task
+    for nested in stage_records:
+        nested.setdefault('layer', layer)
+        nested.setdefault('year', year)
+
+    return record['wall_s'], list(stage_records)
+
+
+def write_run_report(records, results_folder, pixels):
+    """
+    Writes the measures of all stages of a run to run_report.json and
+    run_report.csv in the results folder.
+
+    Parameters
+    ----------
+    records : measures from instrument.
+    results_folder : Folder in root for all results.
+    pixels : pixels of the base raster, for stages without their own count.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    fields = ['stage', 'layer', 'year', 'wall_s', 'cpu_s', 'peak_rss_mb',
+              'read_mb', 'written_mb', 'pixels', 'mpixels_s']
+    rows = []
+    for record in records:
+        row = {field: record.get(field) for field in fields}
+        row['pixels'] = row['pixels'] or pixels
+        if row['wall_s']:
+            row['mpixels_s'] = row['pixels'] / 1e6 / row['wall_s']
+        rows.append(row)
+
+    with open(f'{results_folder}/run_report.json', 'w') as f:
+        json.dump(rows, f, indent=1)
+    with open(f'{results_folder}/run_report.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
 class PREPARING():
     """
     Converts spatial inputs of pressures to a raster that will be later on
@@ -298,7 +894,8 @@ class PREPARING():
     """
 
     def __init__(self, layer, year, settings, base_path, purpose, scoring_template,
-                  scoring_method, results_folder, main_folder, res, multitemp):
+                  scoring_method, results_folder, main_folder, res, multitemp,
+                  workers=1):
         """
 
 
@@ -318,6 +915,8 @@ class PREPARING():
         results_folder : Folder in root for all results.
         main_folder : Name of folder in root for all analysis.
         multitemp : XXX.
+        workers : number of processes to compute tiles of proximity and
+        cost rasters. The default is 1.
 
         Returns
         -------
@@ -328,18 +927,19 @@ class PREPARING():
         # print()
         print(f'      Preparing {layer} {year}')
 
-        # Check if prepared layer exists
-        extent = settings.extent_Polygon
-        extent = extent.split('/')[-1].split('.')[-2]
-        year_txt = f'{year}_' if multitemp else ''
-        purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
-        pressure_path = f'{main_folder}/HF_maps/b03_Prepared_pressures/{extent}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_prepared.tif'
-
-        # If pressure does not exist, create it
-        pressure_exists = os.path.isfile(pressure_path)
+        # Reuse the prepared pressure only if it was made from the same
+        # inputs, otherwise remove it with its intermediate files
+        pressure_path, key, inputs = prepared_artifact(
+            layer, year, settings, base_path, purpose, scoring_template,
+            scoring_method, main_folder, res, multitemp)
+        pressure_exists = is_cached(pressure_path, key)
 
         if not pressure_exists:
 
+            remove_artifacts([pressure_path] + prepared_intermediates(
+                layer, year, settings, purpose, scoring_template,
+                scoring_method, main_folder, res, multitemp))
+
             # Call spatial functions according to scoring method
             if scoring_method in (
                                   'pop_scores_INEC_INEI',
@@ -350,9 +950,18 @@ class PREPARING():
                                   'built_Meta_scores',
                                     ):
 
-                # Warp raster
+                # Warp raster, with the other years of a multitemporal
+                # layer in the same pass
+                batch = self.get_warp_batch(layer, year, settings, base_path,
+                                            purpose, scoring_template,
+                                            scoring_method, main_folder, res,
+                                            multitemp)
                 warp_raster(layer, settings, base_path, pressure_path,
-                            scoring_template, scoring_method, main_folder)
+                            scoring_template, scoring_method, main_folder,
+                            batch=[(f"{main_folder}{layers_settings[layer_b]['path'][0]}", path_b)
+                                   for layer_b, path_b, _, _ in batch])
+                for _, path_b, key_b, inputs_b in batch:
+                    save_artifact_metadata(path_b, key_b, inputs_b)
 
             elif scoring_method in ('road_scores_l1', 'road_scores_l2',
                                     'road_scores_l3', 'road_scores_l4',
@@ -370,7 +979,8 @@ class PREPARING():
                 print('         Creating proximity raster for ' + layer)
                 create_proximity_raster(layer, settings, base_path,
                                         pressure_path,
-                                        scoring_template, main_folder, res)
+                                        scoring_template, main_folder, res,
+                                        workers)
 
             elif scoring_method in ('luc_MAAE_scores', 'bui_MAAE_scores',
                                     'mining_MINAM_scores',
@@ -387,17 +997,49 @@ class PREPARING():
                                                     base_path, pressure_path,
                                                     scoring_template, purpose,
                                                     results_folder, main_folder,
-                                                    res, scoring_method, multitemp)
+                                                    res, scoring_method, multitemp,
+                                                    workers)
 
             else:
                 print(f'{scoring_method} not found in preparing options')
 
-            # Compress result and delete previous version
-            compress(pressure_path)
+            save_artifact_metadata(pressure_path, key, inputs)
 
         else:
             print(f'         {layer} was already prepared')
 
+    def get_warp_batch(self, layer, year, settings, base_path, purpose,
+                       scoring_template, scoring_method, main_folder, res,
+                       multitemp):
+        """
+        Gets the prepared rasters of the other years of the purpose that come
+        from versions of the same multitemporal layer and are not prepared
+        yet, so they're warped in the same pass.
+
+        Returns
+        -------
+        batch : list of (layer, pressure_path, key, inputs).
+
+        """
+
+        batch = []
+        catalogue = get_catalogue()
+        dataset = catalogue.source(layer)
+        if not multitemp or not dataset:
+            return batch
+
+        for year_b in settings.purpose_layers[purpose]['years']:
+            layer_b = catalogue.closest_version(dataset, year_b)
+            path_b, key_b, inputs_b = prepared_artifact(
+                layer_b, year_b, settings, base_path, purpose,
+                scoring_template, scoring_method, main_folder, res, multitemp)
+
+            if year_b != year and not is_cached(path_b, key_b):
+                remove_artifacts([path_b])
+                batch.append((layer_b, path_b, key_b, inputs_b))
+
+        return batch
+
 
 class SCORING():
     """
@@ -443,14 +1085,20 @@ class SCORING():
         extent_str = extent.split('/')[-1].split('.')[-2]
         year_txt = f'{year}_' if multitemp else ''
         purp = f'{purpose}_' if scoring_method in ('indirect_scores') else ''
-        in_path = f'{main_folder}/HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_prepared.tif'
-        scored_path = f'{main_folder}/HF_maps/b04_Scored_pressures/{extent_str}_{layer}_{purp}{year_txt}{scoring_template}_{res}m_scored.tif'
-        score_exists = os.path.isfile(scored_path)
+
+        # Reuse the scored pressure only if it was made from the same
+        # prepared pressure and scores
+        in_path, scored_path, key, inputs = scored_artifact(
+            layer, year, settings, base_path, purpose, scoring_template,
+            scoring_method, main_folder, multitemp, res)
         scoring_method = layers_settings[layer]['scoring']
+        score_exists = is_cached(scored_path, key)
 
         # If pressure does not exist, create it
         if not score_exists:
 
+            remove_artifacts([scored_path])
+
             vecfunc = 'dummy'
 
             # Define function to assign scores according to scoring method
@@ -470,45 +1118,14 @@ class SCORING():
             # Loop through inpaths
             for in_path in in_paths:
 
-                if vecfunc != 'remain':
+                scoring_method2 = in_paths[in_path]['scoring_m']
 
-                    scoring_method2 = in_paths[in_path]['scoring_m']
+                # Open prepared pressure raster
+                not_scored_raster = RASTER(in_paths[in_path]['in_path'])
 
-                    # Open prepared pressure raster
-                    not_scored_raster = RASTER(in_paths[in_path]['in_path'])
-                    not_scored_array = not_scored_raster.get_array()
-                    not_scored_array = not_scored_array.astype(np.float32)
+                self.nodata = not_scored_raster.nodata
 
-                    # Assign parameters for scoring functions
-                    # Float True for creating a floating type raster
-                    Float = True
-                    self.nodata = not_scored_raster.nodata
-                    template = getattr(HF_scores, settings.scoring_template)
-                    scoring_method_template = template[scoring_method2]
-                    if scoring_method_template['func'] == 'bins':
-                        self.scores = scoring_method_template['scores_by_bins']
-                        # Float = True
-                    elif scoring_method_template['func'] == 'exp':
-                        self.direct_score = scoring_method_template['direct_score']
-                        self.max_score_exp = scoring_method_template['max_score_exp']
-                        self.min_score_exp = scoring_method_template['min_score_exp']
-                        self.max_dist = scoring_method_template['max_dist']
-                        # Float = True
-                    elif scoring_method_template['func'] == 'log':
-                        self.max_score = scoring_method_template['max_score']
-                        self.mult_factor = scoring_method_template['mult_factor']
-                        self.min_threshold = scoring_method_template['min_threshold']
-                        self.max_threshold = scoring_method_template['max_threshold']
-                        self.scaling_factor = scoring_method_template['scaling_factor']
-                        # Float = True
-                    elif scoring_method_template['func'] == 'categories':
-                        self.scores = scoring_method_template['scores_by_categories']
-                    elif scoring_method_template['func'] == 'linear':
-                        self.max_score = scoring_method_template['max_score']
-                        self.max_threshold = scoring_method_template['max_threshold']  #  Median for samples in urban areas
-                        self.min_threshold = scoring_method_template['min_threshold']
-                        self.resampling_method = 'bilinear'
-                        # Float = True
+                if vecfunc != 'remain':
 
                     # Get units of original layer
                     self.units = layers_settings[layer]['units']
@@ -517,146 +1134,63 @@ class SCORING():
                     if scoring_method in ('indirect_scores'):
                         self.units = '10seconds'
 
+                    self.denom = None
                     if self.units in ('meters'):#, 'hab/pixel'
-                        denom = 1000
+                        self.denom = 1000
                     elif self.units in ('10seconds'):
-                        denom = 36000
+                        self.denom = 36000
                     elif self.units in ('kilometers', 'hours'):
-                        denom = 1
-
-                    # Assign scores and save new raster
-                    if scoring_method in (
-                            'settlement_scores',
-                            ):
-                        scored_array = \
-                        np.where(not_scored_array > self.max_dist, 0,
-                                 np.where(not_scored_array == 0, self.direct_score,
-                                 self.max_score_exp * np.exp(-(not_scored_array / denom)) + self.min_score_exp
-                                  ))
-
-                    elif scoring_method in (
-                            'indirect_scores',
-                                            ):
-
-                        # Score built as 0 to control for package for calculating distances
-                        # that misses some built areas
-                        max_ind_score = self.max_score_exp
-                        built_path = f'{main_folder}HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_built_{year_txt}{purp}{res}m.tif'
-                        built_raster = RASTER(built_path)
-                        built_array = built_raster.get_array()
-                        scored_array = \
-                        np.where(not_scored_array > self.max_dist, 0,
-                                 np.where(np.logical_or(not_scored_array==0,built_array==1), self.direct_score,
-                                 np.where(self.max_score_exp * np.exp(-(not_scored_array / denom)) + self.min_score_exp < max_ind_score,
-                                 self.max_score_exp * np.exp(-(not_scored_array / denom)) + self.min_score_exp, max_ind_score
-                                  )))
-                        built_raster.close()
-
-                    elif scoring_method in (
-                            'road_scores_l1', 'road_scores_l2',
-                            'road_scores_l3', 'road_scores_l4',
-                            'urban_scores', 'built_Meta_scores',
-                            'Infr_imp_scores', 'Infr_imp_poll_scores_05',
-                            'Infr_imp_poll_scores_15', 'Infr_imp_poll_scores_5',
-                            'Part_imp_poll_05', 'Inf_part_imp_05',
-                            'Inf_part_imp_15', 
-                            'line_inf_poll_scores', 'line_inf_scores',
-                            'plantations_scores',
-                            ):
-
-                    #     Returns score according to bins in HF_scores.py/GHF/scoring_method.
-                        scored_array = copy.deepcopy(not_scored_array)
-                        for i in self.scores:
-                            goods = np.where((i[0][0] <= not_scored_array) & (not_scored_array <= i[0][1]) & (not_scored_array != 65535))
-                            scored_array[goods] = i[1]
-                        del goods
-
-                    #     if value == 65535: return 0  # Value when proximity is empty
-                        scored_array[np.where(not_scored_array == 65535)] = 0
-
-                        # If there is a minimum threshold, make everything below it 0s
-                        try:
-                            scored_array[np.where(not_scored_array < self.min_threshold)] = 0
-                        except:
-                            pass
-
-                    elif scoring_method in (
-                            'pop_scores_INEC_INEI',
-                            'worldpop_scores',
-                    ):
-
-                        scored_array = copy.deepcopy(not_scored_array)
-                        scored_array[np.where(not_scored_array < self.min_threshold)] = 0
-                        scored_array[np.where(not_scored_array > self.max_threshold)] = self.max_score
-                        goods = np.where((self.min_threshold <= not_scored_array) & (not_scored_array <= self.max_threshold))
-                        scored_array[goods] = self.mult_factor * np.log10(((not_scored_array[goods]-self.min_threshold) / self.scaling_factor) + 1)
-                        goods = np.where(scored_array > self.max_score)
-                        scored_array[goods] = self.max_score
-                        goods = np.where(scored_array <0)
-                        scored_array[goods] = 0
-                        del goods
-
-
-
-                    elif scoring_method in (
-                            'ntl_VIIRS_scores',
-                    ):
-
-                        # Make copy to score
-                        scored_array = copy.deepcopy(not_scored_array)
-
-                        # Change everythins outside valid range
-                        scored_array[np.where(not_scored_array < self.min_threshold)] = 0
-                        scored_array[np.where(not_scored_array > self.max_threshold)] = self.max_score
-
-                        # Score linearly inner values
-                        goods = np.logical_and(self.min_threshold <= not_scored_array, not_scored_array <= self.max_threshold)
-                        scored_array[goods] = np.interp(not_scored_array[goods], (self.min_threshold, self.max_threshold), (0, self.max_score))
-
+                        self.denom = 1
 
-                    elif scoring_method in (
-                            'agr_MINAGRI_scores',
-                            'bui_Mapbiopmas_scores', 'luc_Mapbiopmas_scores', 'mining_Mapbiopmas_scores',
-                            ):
-
-                        scored_array = copy.deepcopy(not_scored_array)#.astype(np.intc)
-                        for cat in self.scores:
-                            for val in self.scores[cat][1]:
-                                goods = np.where((not_scored_array==val) & (not_scored_array!=self.nodata))
-                                scored_array[goods] = self.scores[cat][0]
-                        del goods
-
-                        scored_array[np.where(not_scored_array == self.nodata)] = 0
-
-                    else:
-
-                        print('scoring_method not found')
-
-                    del not_scored_array
-
-                    # Create scores raster dataset and save
-                    base_raster = RASTER(base_path)
-                    copy_raster(in_paths[in_path]['scored_path'], base_raster, Float)
-                    base_raster.close()
-                    scores_raster = RASTER(in_paths[in_path]['scored_path'])
-                    save_array(scores_raster.bd, scored_array)
-                    del scored_array
-
-                    # Close rasters
-                    scores_raster.close()
-                    not_scored_raster.close()
+                    # Compile scoring function once according to the type of
+                    # function ('func') of the scoring method in HF_scores
+                    kernel = compile_scoring_kernel(settings.scoring_template,
+                                                    scoring_method2,
+                                                    self.nodata, self.denom)
 
                 else:
-                    # If the scores are already in the raster, just copy the file
-                    shutil.copy2(in_paths[in_path]['in_path'], in_paths[in_path]['scored_path'])
-
-                # Clip score raster to study area
-                clip_raster_by_extent(in_paths[in_path]['scored_path'],
-                                      in_paths[in_path]['scored_path'],
-                                      settings, base_path)
-
-                # Compress result and delete previous version
-                compress(in_paths[in_path]['scored_path'])
+                    # If the scores are already in the raster, keep them
+                    kernel = lambda array, direct_array=None: array
+
+                # Score built as 0 to control for package for calculating distances
+                # that misses some built areas
+                built_raster = None
+                if scoring_method in ('indirect_scores'):
+                    built_path = f'{main_folder}HF_maps/b03_Prepared_pressures/{extent_str}_{layer}_built_{year_txt}{purp}{res}m.tif'
+                    built_raster = RASTER(built_path)
+
+                # Create empty scores raster from base raster settings
+                base_grid = get_base_grid(base_path)
+                scores_ds = create_empty_raster(in_paths[in_path]['scored_path'],
+                                                base_grid, kind='scores')
+                scores_bd = scores_ds.GetRasterBand(1)
+                scores_nodata = scores_bd.GetNoDataValue()
+
+                # Score and save block by block, so memory is bounded by
+                # the size of the window and not by the size of the country.
+                # Scores are clipped to the study area (mask of base raster)
+                # before being written, so the file is written only once
+                for window in block_windows(not_scored_raster):
+                    not_scored_array = not_scored_raster.get_window(window)
+                    not_scored_array = not_scored_array.astype(np.float32)
+                    built_array = None
+                    if built_raster:
+                        built_array = built_raster.get_window(window)
+
+                    scored_array = kernel(not_scored_array, built_array)
+                    scored_array[~base_grid.get_mask_window(window)] = scores_nodata
+                    scores_bd.WriteArray(scored_array, window[0], window[1])
+                    del not_scored_array, built_array, scored_array
+
+                # Close rasters
+                scores_bd.ComputeStatistics(0)
+                scores_bd, scores_ds = None, None
+                not_scored_raster.close()
+                if built_raster:
+                    built_raster.close()
+
+                save_artifact_metadata(in_paths[in_path]['scored_path'],
+                                       key, inputs)
 
         else:
             print(f'         {layer} was already scored')
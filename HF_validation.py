@@ -38,7 +38,10 @@ from HF_scores import Urban_area_score, Densily_populated_areas_score, Infrastru
 import os
 # from affine import Affine
 import geopandas as gpd
-import rasterstats as rs
+import rasterio
+import shapely
+from rasterio.windows import Window
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from sklearn.metrics import cohen_kappa_score
 # import sklearn.metrics
@@ -124,9 +127,126 @@ def calculate_visual_score(vdf, fields_vis_scores, other_fields,
     return vdf
 
 
-def extract_values(vis_path, raster_path):
-    raster = rs.zonal_stats(vis_path, raster_path, stats="mean")
-    return [feature['mean'] for feature in raster]
+class ZONES_SAMPLER():
+    """
+    Pixels of the validation geometries on a raster grid, found once, so
+    the mean of every raster of the same grid is sampled with windowed
+    reads of those pixels only. As rasterstats.zonal_stats with
+    stats="mean": pixels with their center in a polygon, or the pixel of a
+    point, NoData excluded, NaN if no pixels.
+
+    Parameters
+    ----------
+    geometries : GeoSeries of the validation geometries.
+
+    """
+
+    def __init__(self, geometries):
+        self.geometries = geometries
+        self.grids = {}
+
+    def zones(self, transform, width, height):
+        """
+        Window and mask of pixels of each geometry on a grid, sorted by row
+        so blocks are read in order. Cached by grid.
+
+        Returns
+        -------
+        List of (position, window, mask), mask None for a single pixel.
+
+        """
+
+        grid = (tuple(transform), width, height)
+        if grid in self.grids:
+            return self.grids[grid]
+
+        zones = []
+        inverse = ~transform
+        for position, geometry in enumerate(self.geometries):
+            if geometry is None or geometry.is_empty:
+                continue
+
+            # Pixel of a point
+            if geometry.geom_type == 'Point':
+                col, row = (int(np.floor(value))
+                            for value in inverse * (geometry.x, geometry.y))
+                if 0 <= row < height and 0 <= col < width:
+                    zones.append((position, Window(col, row, 1, 1), None))
+                continue
+
+            # Pixels with their center in other geometries
+            xmin, ymin, xmax, ymax = geometry.bounds
+            cols, rows = zip(inverse * (xmin, ymax), inverse * (xmax, ymin))
+            col_off, row_off = (max(0, int(np.floor(min(values))))
+                                for values in (cols, rows))
+            col_end, row_end = (min(size, int(np.ceil(max(values))))
+                                for values, size in ((cols, width),
+                                                     (rows, height)))
+            if col_end <= col_off or row_end <= row_off:
+                continue
+            window = Window(col_off, row_off, col_end - col_off,
+                            row_end - row_off)
+            xs, ys = np.meshgrid(np.arange(col_off, col_end) + 0.5,
+                                 np.arange(row_off, row_end) + 0.5)
+            xs, ys = transform * (xs, ys)
+            mask = shapely.contains_xy(geometry, xs, ys)
+            if mask.any():
+                zones.append((position, window, mask))
+
+        zones.sort(key=lambda zone: (zone[1].row_off, zone[1].col_off))
+        self.grids[grid] = zones
+        return zones
+
+    def mean(self, raster_path):
+        """
+        Mean of a raster in each geometry.
+
+        Returns
+        -------
+        Array of means, in the order of the geometries.
+
+        """
+
+        means = np.full(len(self.geometries), np.nan)
+        with rasterio.open(raster_path) as src:
+            for position, window, mask in self.zones(src.transform,
+                                                     src.width, src.height):
+                values = src.read(1, window=window)
+                if mask is not None:
+                    values = values[mask]
+                values = values.ravel().astype(np.float64)
+                if src.nodata is not None:
+                    values = values[values != src.nodata]
+                if values.size:
+                    means[position] = values.mean()
+
+        return means
+
+    def sample(self, raster_paths, workers=4):
+        """
+        Means of several rasters in each geometry, one raster per thread.
+
+        Parameters
+        ----------
+        raster_paths : dict of column name and raster path.
+        workers : number of threads. The default is 4.
+
+        Returns
+        -------
+        DataFrame with a column per raster, index of the geometries.
+
+        """
+
+        # Zones of each grid are found before sampling in threads
+        for raster_path in raster_paths.values():
+            with rasterio.open(raster_path) as src:
+                self.zones(src.transform, src.width, src.height)
+
+        with ThreadPoolExecutor(workers) as executor:
+            means = executor.map(self.mean, raster_paths.values())
+            columns = dict(zip(raster_paths, means))
+
+        return pd.DataFrame(columns, index=self.geometries.index)
 
 
 def values_from_rasters(vis_path, vdf, country_field, results_folder,
@@ -146,28 +266,31 @@ def values_from_rasters(vis_path, vdf, country_field, results_folder,
         # res = settings.pixel_res
         map_txt = '_map'
         
-        # Create empty df
-        raster_values_df = pd.DataFrame(index=vdf.index)
-        
-        # pressure_paths = {}
+        # Rasters of pressures and HF that exist
+        raster_paths = {}
+        missing = []
         for pressure, scored_fields in pressures_dict.items():
-            # if not pressure=='cont_cat':
             initial_txt='' if pressure[:3]=='HF_' else 'p_'
-            # print(pressure, scored_fields)
             raster_path = f'{initial_txt}{pressure}_{lim_txt}_{purpose}_2018_GHF_{res}m.tif'
     
             exists = os.path.isfile(results_folder+raster_path)
             if exists:
-                raster_values_df[pressure+map_txt] = extract_values(vis_path, results_folder+raster_path)
-                raster_values_df[pressure+map_txt] = raster_values_df[pressure+map_txt].fillna(0)
+                raster_paths[pressure+map_txt] = results_folder+raster_path
             else:
-                raster_values_df[pressure+map_txt] = 0
-    
-        for raster_name, raster_path in other_rasters.items():
-            # vdf[raster_name] = extract_values(vis_path, raster_path)
-            raster_values_df[raster_name] = extract_values(vis_path, raster_path)
-            # vdf[raster_name] = vdf[raster_name].fillna(0)       
-            
+                missing.append(pressure+map_txt)
+        raster_paths.update(other_rasters)
+
+        # Sample all rasters reading the validation geometries once
+        raster_values_df = ZONES_SAMPLER(vdf.geometry).sample(raster_paths)
+        for column in raster_paths:
+            if column not in other_rasters:
+                raster_values_df[column] = raster_values_df[column].fillna(0)
+        for column in missing:
+            raster_values_df[column] = 0
+        raster_values_df = raster_values_df[
+            [pressure + map_txt for pressure in pressures_dict]
+            + list(other_rasters)]
+
         # Save df
         raster_values_df.to_csv(raster_values_df_path)
         
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of HF_spatial.
+
+Run with: python -m pytest test_HF_spatial.py
+"""
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+import rasterio
+import geopandas as gpd
+from shapely.geometry import Point
+from rasterio.transform import from_origin
+from skimage.graph import MCP_Geometric
+
+import HF_spatial
+
+
+def test_compute_cost_path_uint16(tmp_path):
+    # Times raster as written by create_times_raster (UInt16, NoData 65535)
+    rng = np.random.default_rng(0)
+    costs = rng.integers(1, 100, (20, 20)).astype(np.uint16)
+    costs[5:15, 9] = 65535
+    costs[15:20, 14] = 65535  # closes an area no source reaches
+    costs[15, 14:20] = 65535
+    transform = from_origin(0, 600, 30, 30)
+    cost_path = str(tmp_path / 'times.tif')
+    with rasterio.open(cost_path, 'w', driver='GTiff', width=20, height=20,
+                       count=1, dtype='uint16', nodata=65535,
+                       transform=transform, crs='EPSG:32717') as dst:
+        dst.write(costs, 1)
+
+    points_path = str(tmp_path / 'points.gpkg')
+    gpd.GeoDataFrame(geometry=[Point(45, 555)],
+                     crs='EPSG:32717').to_file(points_path, driver='GPKG')
+
+    out_path = str(tmp_path / 'cumulative.tif')
+    HF_spatial.compute_cost_path(cost_path, points_path, out_path,
+                                 tile_size=8, halo=2)
+
+    with rasterio.open(out_path) as src:
+        cumulative = src.read(1)
+
+    # Same costs as skimage over the whole raster, NoData where impassable
+    # and inf where no source reaches
+    nodata = costs == 65535
+    expected, _ = MCP_Geometric(
+        np.where(nodata, -1.0, costs.astype(float))).find_costs([(1, 1)])
+    assert (cumulative[nodata] == -9999).all()
+    assert cumulative[1, 1] == 0
+    assert np.isinf(cumulative[17:20, 16:20]).all()
+    np.testing.assert_allclose(cumulative[~nodata], expected[~nodata],
+                               rtol=1e-6)